@@ -1,282 +1,852 @@
-import copy
-import math
+import array
+import concurrent.futures
+import heapq
+import multiprocessing
+import time
+
 import networkx as nx
 import numpy as np
 
+import bellman_ford
 import graph_utils
+import tracing
+import wd
+import wd_cache
+from retiming_graph import RetimingGraph, as_retiming_graph, zero_register_delta
 
 
-def WD(G: nx.DiGraph):
-    # Retrieve all the node delays
-    node_delays = np.array([int(G.nodes[node]['d']) for node in G.nodes])
-    node_dict = dict(zip(list(G.nodes), list(range(len(node_delays)))))
-    node_dict_inv = dict(zip(list(range(len(node_delays))), list(G.nodes)))
-
-    class Weight:
-        def __init__(self, w, d):
-            self.w = w
-            self.d = d
-
-        def __add__(self, other):
-            return Weight(self.w + other.w, self.d + other.d)
-
-        def __le__(self, other):
-            if self.w < other.w:
-                return True
-            elif self.w == other.w and self.d > other.d:
-                return True
-            else:
-                return False
-
-        def __str__(self):
-            return f"[{self.w}, {self.d}]"
-
-        def __repr__(self):
-            return self.__str__()
+def WD(G, method='auto', n_jobs=1, directory=None, tile_budget=wd.DEFAULT_TILE_BUDGET, cache=None, tracer=None):
+    RG, _ = as_retiming_graph(G)
 
-    A = np.matrix(nx.to_numpy_matrix(G, weight='w', nonedge=np.inf))
-    A = A.astype(np.object)
-
-    for u, v in G.edges:
-        A[node_dict[u], node_dict[v]] = Weight(G[u][v]['w'], G[u][v]['d'])
-
-    n, m = A.shape
-
-    _edges = set([(node_dict[u], node_dict[v]) for u,v in G.edges])
-    for row in range(n):
-        for col in range(m):
-            if (row, col) not in _edges:
-                A[row, col] = Weight(np.inf, np.inf)
-            else:
-                u = node_dict_inv[row]
-                v = node_dict_inv[col]
-                A[row, col] = Weight(G[u][v]['w'], G[u][v]['d'])
-
-    n, m = A.shape
-    A[np.identity(n) == 1] = Weight(0,0)  # diagonal elements should be zero
-    for i in range(n):
-        A = np.minimum(A, A[i, :] + A[:, i])
-
-    W = np.empty(shape=A.shape, dtype=int)
-    D = np.empty(shape=A.shape, dtype=int)
-    for row in range(n):
-        for col in range(m):
-            W[row, col] = A[row, col].w
-            D[row, col] = A[row, col].d
-
-    # Add the starting delay
-    for x in range(D.shape[0]):
-        D[x] = D[x] + node_delays
+    if method == 'auto':
+        method = wd.choose_method(RG, n_jobs)
 
+    with tracing.span(tracer, 'WD', method=method, nodes=RG.n_nodes, edges=RG.n_edges) as args:
+        W, D = _wd(RG, method, n_jobs, directory, tile_budget, cache)
+        args['bytes'] = W.nbytes + D.nbytes
     return W, D
 
 
-def CP(G: nx.DiGraph):
-
-    # Retrieve the edges where w is equal to zero
-    relevant_edges = [(u, v) for u, v in G.edges if G.get_edge_data(u, v)['w'] == 0]
+def _wd(RG: RetimingGraph, method, n_jobs, directory, tile_budget, cache):
+    # W and D of a circuit already seen are read from the cache, the tiled engine already keeps
+    # them on disk in directory
+    if cache is not None and method != 'tiled':
+        entry = cache.load(RG)
+        if entry is None:
+            W, D = _wd(RG, method, n_jobs, directory, tile_budget, None)
+            cache.store(RG, W, D, candidate_clocks(RG, D, tile_budget))
+            return W, D
+        return entry[0], entry[1]
+
+    if method == 'dense':
+        # Floyd-Warshall on the packed (w, -d) integer keys
+        return wd.dense(RG)
+    elif method == 'sparse':
+        # One Dijkstra per source vertex, the rows are spread over n_jobs processes
+        return wd.sparse(RG, n_jobs=n_jobs)
+    elif method == 'blocked':
+        # Blocked Floyd-Warshall in memory, the tiles of each phase are spread over n_jobs threads
+        return wd.blocked(RG, n_threads=n_jobs)
+    elif method == 'tiled':
+        # Blocked Floyd-Warshall, W and D are memory mapped .npy files in directory
+        return wd.tiled(RG, directory=directory, tile_budget=tile_budget, n_threads=n_jobs)
+    else:
+        raise ValueError(f"Unknown WD method {method}")
 
-    # Create a new graph in order to avoid side effects on the current one
-    X = nx.DiGraph()
 
-    # Add only the relevant edges to the new graph
-    [X.add_edge(u, v, w=G[u][v]['w']) for u, v in relevant_edges]
+def CP(G):
+    RG, is_nx = as_retiming_graph(G)
 
-    # Topological sort the graph
-    sorted_vertices = nx.topological_sort(X)
+    # Compute DELTA delay
+    delta = zero_register_delta(RG, RG.edge_w)
 
-    # DELTA (as described in the paper)
-    delta = {}
+    # Return DELTA
+    if is_nx:
+        return dict(zip(RG.node_names, delta.tolist()))
+    return delta
 
-    # Compute the starting DELTA for each vertex
-    for vertex in G.nodes:
-        delta[vertex] = int(G.nodes[vertex]['d'])
 
-    # Declare a function that compute incrementally DELTA
-    def compute_delay(G, vertex, delay):
-        in_vertices = [u for u, v in G.in_edges(vertex)]
-        if len(in_vertices) == 0:
-            delta[vertex] = delay
-        else:
-            delta[vertex] = max(delta[vertex] for vertex in in_vertices) + delay
+def _retimed(G, RG: RetimingGraph, r, is_nx):
+    # Build the retimed graph with the same representation of the input graph
+    if is_nx:
+        return graph_utils.retime_graph(G, dict(zip(RG.node_names, r.tolist())))
+    return RG.retime(r)
+
+
+def _period_constraints(W, D, c, tile_budget=wd.DEFAULT_TILE_BUDGET, limit=None):
+    # Pairs (x, y) with D(x, y) > c, their bound W(x, y) - 1 and their D(x, y),
+    # scanning W and D a block of rows at a time. None if there are more than limit pairs.
+    x, y, w_xy, d_xy = [[np.empty(0, dtype=np.int64)] for _ in range(4)]
+    count = 0
+    for start, W_block, D_block in wd.iter_row_blocks(W, D, tile_budget=tile_budget):
+        rows, cols = np.nonzero(D_block > c)
+        count += rows.size
+        if limit is not None and count > limit:
+            return None
+        x.append(rows + start)
+        y.append(cols)
+        w_xy.append(W_block[rows, cols] - 1)
+        d_xy.append(D_block[rows, cols])
+    return np.concatenate(x), np.concatenate(y), np.concatenate(w_xy), np.concatenate(d_xy)
+
+
+class PeriodConstraints:
+    # Constraint edges of every clock c >= lower, built once. The edges of the circuit come first,
+    # then the edges r(x) - r(y) <= W(x, y) - 1 by decreasing D(x, y): the constraint graph of a
+    # clock c is a prefix of the arrays, and moving c only moves the end of the prefix. The edges
+    # are also sorted once by target vertex, a probe keeps the ones of its prefix in that order.
+    # A circuit edge u -> v is implied by the constraint of the pair (u, v), W(u, v) <= w(e), so
+    # a probe skips it as long as that constraint is in the prefix, i.e. for c < D(u, v).
+
+    def __init__(self, G: RetimingGraph, W, D, lower, tile_budget=wd.DEFAULT_TILE_BUDGET):
+        x, y, w_xy, d_xy = _period_constraints(W, D, lower, tile_budget)
+        order = np.argsort(-d_xy, kind='stable')
+        self.n_nodes = G.n_nodes
+        self.n_edges = G.n_edges
+        self.lower = lower
+        self.delays = d_xy[order]
+        self.src = np.concatenate([G.edge_dst, y[order]])
+        self.dst = np.concatenate([G.edge_src, x[order]])
+        self.weight = np.concatenate([G.edge_w, w_xy[order]])
+        self.by_target = np.argsort(self.dst, kind='stable')
+        edge_d = np.append(np.asarray(D[G.edge_src, G.edge_dst]), 0)
+        self.needed_from = edge_d[np.minimum(self.by_target, G.n_edges)]
+
+    def size(self, c):
+        # Number of constraint edges of clock c (the D(x, y) > c ones plus the circuit edges)
+        assert c >= self.lower, "the clock is lower than the smallest clock of the constraints"
+        return self.n_edges + int(np.searchsorted(-self.delays, -c, side='left'))
+
+    @property
+    def nbytes(self):
+        return (self.delays.nbytes + self.src.nbytes + self.dst.nbytes + self.weight.nbytes + self.by_target.nbytes +
+                self.needed_from.nbytes)
+
+    def solve(self, c, initial=None, stats=None, abort=None):
+        m = self.size(c)
+        edges = self.by_target[(self.by_target < m) & (self.needed_from <= c)]
+        if stats is not None:
+            stats['constraint_edges'] = edges.size
+        return bellman_ford.solve(self.n_nodes, self.src[edges], self.dst[edges], self.weight[edges], initial, stats,
+                                  grouped=True, abort=abort)
+
+
+class StreamedConstraints:
+    # Same interface as PeriodConstraints, but no constraint is kept between two probes: the
+    # constraints of a clock are read from W and D if they fit in the tile budget, otherwise
+    # every Bellman-Ford round reads W and D again a block of rows at a time. The memory stays
+    # within the tile budget whatever the number of pairs with D(x, y) > c.
+
+    def __init__(self, G: RetimingGraph, W, D, tile_budget=wd.DEFAULT_TILE_BUDGET):
+        self.G = G
+        self.W = W
+        self.D = D
+        # W, D, their bounds and the candidates of a block: about 6 arrays of the block size
+        self.tile_budget = tile_budget // 3
+        self.nbytes = 0
+
+    def solve(self, c, initial=None, stats=None, abort=None):
+        G = self.G
+        pairs = _period_constraints(self.W, self.D, c, self.tile_budget, self.tile_budget // CONSTRAINT_BYTES)
+        if pairs is not None:
+            x, y, w_xy, _ = pairs
+            src, dst, weight = bellman_ford.difference_constraints(G.n_nodes,
+                                                                   np.concatenate([x, G.edge_src]),
+                                                                   np.concatenate([y, G.edge_dst]),
+                                                                   np.concatenate([w_xy, G.edge_w]))
+            if stats is not None:
+                stats['constraint_edges'] = src.size
+            return bellman_ford.solve(G.n_nodes, src, dst, weight, initial, stats, abort=abort)
+
+        def row_blocks():
+            for start, W_block, D_block in wd.iter_row_blocks(self.W, self.D, tile_budget=self.tile_budget):
+                yield start, np.where(D_block > c, W_block - 1, bellman_ford.NO_BOUND)
+
+        return bellman_ford.solve_rows(G.n_nodes, G.edge_dst, G.edge_src, G.edge_w, row_blocks, initial, stats, abort)
+
+
+# Bytes held per constraint while a PeriodConstraints is built (pairs, sort order and sorted copies)
+CONSTRAINT_BYTES = 12 * 8
+
+
+def period_constraints(G: RetimingGraph, W, D, lower, tile_budget=wd.DEFAULT_TILE_BUDGET):
+    # PeriodConstraints if the constraints of the clock lower fit in the tile budget, the
+    # streamed ones otherwise: with W and D out of core they can be many times the budget
+    count = sum(int(np.count_nonzero(D_block > lower)) for _, D_block in wd.iter_row_blocks(D, tile_budget=tile_budget))
+    if count * CONSTRAINT_BYTES > tile_budget:
+        return StreamedConstraints(G, W, D, tile_budget)
+    return PeriodConstraints(G, W, D, lower, tile_budget)
+
+
+def clock_bounds(G: RetimingGraph):
+    # Every clock is at least the maximum node delay, and the clock of the circuit itself
+    # (r = 0) is always feasible
+    return int(G.delays.max()), int(zero_register_delta(G, G.edge_w).max())
+
+
+def candidate_clocks(G: RetimingGraph, D, tile_budget=wd.DEFAULT_TILE_BUDGET, cache=None):
+    # The values of D between the bounds (the maximum delay and the clock of G), the only clocks
+    # that are worth probing. D is read a block of rows at a time.
+    if cache is not None:
+        entry = cache.load(G)
+        if entry is not None:
+            return entry[2]
+    lower, upper = clock_bounds(G)
+    return wd.unique_values(D, tile_budget, lower, upper)
+
+
+class SearchState:
+    # Where a search over the candidate clocks stopped: every clock below lower is not feasible
+    # and upper is feasible with the retiming r (r is None for the clock of the graph itself,
+    # r = 0). A search given a state starts from it and updates it, so a search stopped by its
+    # budget can be resumed, even by the other algorithm: both probe the same candidates.
+
+    def __init__(self, lower=None, upper=None, r=None, key=None):
+        self.lower = lower
+        self.upper = upper
+        self.r = r
+        self.key = key
+
+    @property
+    def done(self):
+        # The search is over when the bounds meet: upper is the minimum clock
+        return self.lower is not None and self.upper is not None and self.lower >= self.upper
+
+    def check(self, G: RetimingGraph):
+        # The state belongs to the first graph it is used with
+        key = wd_cache.graph_key(G)
+        if self.key is None:
+            self.key = key
+        elif self.key != key:
+            raise ValueError("the search state belongs to another graph")
+
+    def bounds(self, candidates):
+        # Indices of the search range [lo, hi] in candidates, and the retiming of candidates[hi]
+        lo, hi = 0, candidates.size - 1
+        if self.lower is not None:
+            lo = min(int(np.searchsorted(candidates, self.lower, side='left')), hi)
+        if self.r is not None:
+            hi = min(int(np.searchsorted(candidates, self.upper, side='left')), hi)
+        return min(lo, hi), hi, self.r
+
+    def update(self, candidates, lo, hi, best_r):
+        self.lower = int(candidates[lo])
+        self.upper = int(candidates[hi])
+        self.r = best_r
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            np.savez(f, lower=self.lower, upper=self.upper, key=self.key,
+                     r=np.empty(0, dtype=np.int64) if self.r is None else self.r)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as data:
+            r = data['r']
+            state = SearchState(int(data['lower']), int(data['upper']), r if r.size else None, str(data['key']))
+        return state
+
+
+def _deadline(budget):
+    # Time (time.monotonic) after which no probe is started
+    return None if budget is None else time.monotonic() + budget
+
+
+def _trace_probe(tracer, c, stats):
+    # Counter tracks of the search: the clock of every probe, and the Bellman-Ford rounds or
+    # the FEAS iterations it took
+    tracing.counter(tracer, 'probed clock', c=int(c))
+    if 'rounds' in stats:
+        tracing.counter(tracer, 'Bellman-Ford rounds', rounds=stats['rounds'])
+    if 'iterations' in stats:
+        tracing.counter(tracer, 'FEAS iterations', iterations=stats['iterations'])
+
+
+def _out_of_time(lower, upper, verbose, state):
+    # Without a state the caller has no other way to learn the bounds of the minimum clock,
+    # so they are printed even without verbose
+    if verbose or state is None:
+        print(f"Out of time: the minimum clock is between {lower} and {upper}")
+
+
+def _binary_search(candidates, probe, verbose=False, state=None, deadline=None):
+    # candidates[:lo] are not feasible and candidates[hi] is feasible: the last candidate, the
+    # clock of the graph itself, is feasible with r = 0. probe(c, best_r) returns a retiming of
+    # clock c or None, best_r is the retiming of the smallest feasible clock found so far.
+    # The search starts from state, if given, and stops early once deadline is over.
+    lo, hi = 0, candidates.size - 1
+    best_r = None
+    if state is not None:
+        lo, hi, best_r = state.bounds(candidates)
+
+    while lo < hi:
+        if deadline is not None and time.monotonic() >= deadline:
+            _out_of_time(candidates[lo], candidates[hi], verbose, state)
+            break
 
-    # Compute DELTA delay
-    [compute_delay(X, vertex, int(G.nodes[vertex]['d'])) for vertex in sorted_vertices]
+        mid = (lo + hi) // 2
+        c = candidates[mid]
+        r = probe(c, best_r)
+        is_feasible = r is not None
 
-    # Return DELTA
-    return delta
+        if verbose:
+            print(f"Clock {c} {'is' if is_feasible else 'is NOT'} feasible")
 
+        if is_feasible:
+            hi = mid
+            best_r = r
+        else:
+            lo = mid + 1
 
-def OPT_1(G: nx.DiGraph, W: np.matrix, D: np.matrix, verbose=False):
-    # Initiliaze returned value
-    r = {}
-    best_r = {}
-    best_c = np.inf
+    if state is not None:
+        state.update(candidates, lo, hi, best_r)
+    return best_r
 
-    # Auxiliary structures
-    node_names = np.array(G.nodes, np.object)
-    tested_c = set([])
 
-    # Initialize binary search data structure
-    binary_search_array = np.array(sorted(D.flat))
-    binary_search_array = np.unique(binary_search_array)
-    binary_search_step = int(binary_search_array.size / 2)
-    binary_search_index = binary_search_step
+_probe_state = {}
 
-    # Binary search
-    for _ in range(math.ceil(math.log2(binary_search_array.size)) + 1):
 
-        # Check exit condition:
-        if binary_search_index >= len(binary_search_array) or binary_search_index < 0:
-            break
+def _init_probe_worker(algorithm, G: RetimingGraph, W, D, tile_budget, propagation, bracket):
+    # Every worker of the pool keeps its own copy of the graph and of the constraints
+    _probe_state.update(algorithm=algorithm, G=G, propagation=propagation, bracket=bracket)
+    if algorithm == 'OPT_1':
+        _probe_state['constraints'] = period_constraints(G, W, D, clock_bounds(G)[0], tile_budget)
 
-        # Retrieve a clock and try it if feasible
-        c = binary_search_array[binary_search_index]
 
-        if c not in tested_c:
-            # c = 10
-            # Retrieve the index of the path with delay greater than c
-            indices = np.where(D > c, D, 0).nonzero()
+def _probe(c):
+    # Retiming of clock c, or None if c is not feasible. The probe gives up (None) as soon as c
+    # leaves the bracket [lower, upper) of the search: its result can no longer matter.
+    bracket = _probe_state['bracket']
 
+    def abort():
+        return not bracket[0] <= c < bracket[1]
 
-            # Create a graph to solve the ILP
-            bellman_ford_solver_graph = nx.DiGraph()
+    if _probe_state['algorithm'] == 'OPT_1':
+        return _probe_state['constraints'].solve(c, abort=abort)
+    return _feas(_probe_state['G'], c, _probe_state['propagation'], abort=abort)
 
 
-            # Add constraints
-            for x, y in zip(indices[0], indices[1]):
-                u = node_names[x]
-                v = node_names[y]
-                w = W[x, y] - 1
-                # print(f"{x} - {y} <= {w}")
-                if bellman_ford_solver_graph.has_edge(v,u):
-                    if bellman_ford_solver_graph[v][u]['w'] > w:
-                        bellman_ford_solver_graph[v][u]['w'] = w
+def _split_points(lo, hi, running, k):
+    # Up to k new indices of [lo, hi) to probe: each one is the middle of the largest range of
+    # indices that neither the bounds nor the running probes already split
+    points = sorted(i for i in running if lo <= i < hi)
+    picks = []
+    for _ in range(k):
+        edges = [lo - 1] + points + [hi]
+        a, b = max(zip(edges, edges[1:]), key=lambda gap: gap[1] - gap[0])
+        if b - a < 2:
+            break
+        picks.append((a + b + 1) // 2)
+        points = sorted(points + picks[-1:])
+    return picks
+
+
+def _parallel_search(candidates, n_jobs, initargs, verbose=False, state=None, deadline=None):
+    # Speculative k-ary search: n_jobs clocks of the current range are probed at the same time,
+    # and every worker that finishes a probe starts the next one in the range left, without
+    # waiting for the other probes. candidates[:lo] are not feasible, candidates[hi:] are
+    # feasible (the last one with r = 0).
+    lo, hi = 0, candidates.size - 1
+    best_r = None
+    if state is not None:
+        lo, hi, best_r = state.bounds(candidates)
+
+    # The clocks candidates[lo] and candidates[hi], shared with the workers: a running probe
+    # stops once its clock is out of them. The bracket only shrinks, so a worker that reads one
+    # bound before and the other after an update still sees a bracket around the current one.
+    bracket = multiprocessing.RawArray('q', [int(candidates[lo]), int(candidates[hi])])
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs,
+                                                initializer=_init_probe_worker,
+                                                initargs=initargs + (bracket,)) as executor:
+        running = {}
+        while lo < hi:
+            # As in the binary search, the deadline is checked before starting new probes. The
+            # probes out of the range stay in running until they notice it: they hold a worker.
+            if deadline is None or time.monotonic() < deadline:
+                for i in _split_points(lo, hi, running.values(), n_jobs - len(running)):
+                    running[executor.submit(_probe, candidates[i])] = i
+            elif not any(lo <= i < hi for i in running.values()):
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                if not lo <= i < hi:
+                    continue
+                r = future.result()
+                if verbose:
+                    print(f"Clock {candidates[i]} {'is' if r is not None else 'is NOT'} feasible")
+                if r is None:
+                    lo = i + 1
                 else:
-                    bellman_ford_solver_graph.add_edge(v, u, w=w)
-
-            # Add constraints
-            for nodes, edge_property in G.edges.items():
-                u = nodes[0]
-                v = nodes[1]
-                w = edge_property['w']
-                # print(f"{u} - {v} <= {w}")
-                if bellman_ford_solver_graph.has_edge(v,u):
-                    if bellman_ford_solver_graph[v][u]['w'] > w:
-                        bellman_ford_solver_graph[v][u]['w'] = w
+                    hi = i
+                    best_r = r
+            bracket[0], bracket[1] = int(candidates[lo]), int(candidates[hi])
+
+        # The search is over, or out of time: the probes still running stop too
+        bracket[0] = bracket[1]
+
+    if lo < hi:
+        _out_of_time(candidates[lo], candidates[hi], verbose, state)
+    if state is not None:
+        state.update(candidates, lo, hi, best_r)
+    return best_r
+
+
+def OPT_1(G, W: np.ndarray, D: np.ndarray, verbose=False, tile_budget=wd.DEFAULT_TILE_BUDGET, incremental=True,
+          n_jobs=1, cache=None, budget=None, state=None, tracer=None):
+    # With a budget (seconds) the search stops at the first probe that would start after it,
+    # and the best retiming found so far is returned. The search starts from state and
+    # updates it (see SearchState): state.lower is then a proven lower bound of the clock.
+    RG, is_nx = as_retiming_graph(G)
+    n = RG.n_nodes
+    deadline = _deadline(budget)
+    if state is not None:
+        state.check(RG)
+
+    with tracing.span(tracer, 'OPT_1', nodes=n, edges=RG.n_edges, incremental=incremental, jobs=n_jobs):
+        best_r = _opt_1(RG, W, D, verbose, tile_budget, incremental, n_jobs, cache, tracer, state, deadline)
+    return _retimed(G, RG, np.zeros(n, dtype=np.int64) if best_r is None else best_r, is_nx)
+
+
+def _opt_1(RG: RetimingGraph, W, D, verbose, tile_budget, incremental, n_jobs, cache, tracer, state, deadline):
+    n = RG.n_nodes
+
+    with tracing.span(tracer, 'candidate_clocks') as args:
+        candidates = candidate_clocks(RG, D, tile_budget, cache)
+        args['candidates'] = candidates.size
+
+    if n_jobs > 1:
+        return _parallel_search(candidates, n_jobs, ('OPT_1', RG, W, D, tile_budget, None), verbose, state, deadline)
+
+    # Sort the constraints once, every probe then adds or removes only the constraints
+    # whose D lies between the previous clock and the current one. If they do not fit in
+    # the tile budget, or without incremental, every probe streams W and D instead.
+    with tracing.span(tracer, 'PeriodConstraints') as args:
+        if incremental:
+            constraints = period_constraints(RG, W, D, candidates[0], tile_budget)
+        else:
+            constraints = StreamedConstraints(RG, W, D, tile_budget)
+        args.update(streamed=isinstance(constraints, StreamedConstraints), bytes=constraints.nbytes)
+
+    def probe(c, best_r):
+        with tracing.span(tracer, 'probe', c=int(c)) as args:
+            r = solve(c, best_r, args)
+            args['feasible'] = r is not None
+        _trace_probe(tracer, c, args)
+        return r
+
+    def solve(c, best_r, stats):
+        # Warm start from the solution of the smallest feasible clock found so far:
+        # its constraints are a subset of the current ones
+        return constraints.solve(c, initial=best_r, stats=stats)
+
+    return _binary_search(candidates, probe, verbose, state, deadline)
+
+
+def _lean_constraints(G: RetimingGraph, succ, h, c, sources):
+    # Period constraints of clock c without W and D: a Dijkstra on the reweighted keys (see
+    # wd.reduced_adjacency) from every source u stops at the first vertices v with D(u, v) > c.
+    # The constraint r(u) - r(v) <= W(u, v) - 1 of a vertex beyond v is implied by the one of v
+    # and by the edges of the path from v, and the delay only grows along a path, so the search
+    # never goes further. Return the constraints and the smallest D(u, v) > c found.
+    M = wd.key_base(G)
+    delays = G.delays.tolist()
+    x, y, bound = array.array('q'), array.array('q'), array.array('q')
+    next_clock = None
+    # settled[v] == source marks the vertices already settled by the current search
+    settled = [-1] * G.n_nodes
+
+    for source in sources:
+        dist = {source: 0}
+        heap = [(0, source)]
+        hs = h[source]
+        while heap:
+            k, u = heapq.heappop(heap)
+            if settled[u] == source:
+                continue
+            settled[u] = source
+
+            # Undo the reweighting: key = W * M - (D - d(u))
+            key = k - hs + h[u]
+            w_su = -(-key // M)
+            d_su = w_su * M - key + delays[u]
+            if d_su > c:
+                x.append(source)
+                y.append(u)
+                bound.append(w_su - 1)
+                if next_clock is None or d_su < next_clock:
+                    next_clock = d_su
+                continue
+
+            for v, rk in succ[u]:
+                nk = k + rk
+                if settled[v] != source and nk < dist.get(v, nk + 1):
+                    dist[v] = nk
+                    heapq.heappush(heap, (nk, v))
+
+    return np.frombuffer(x, dtype=np.int64), np.frombuffer(y, dtype=np.int64), \
+        np.frombuffer(bound, dtype=np.int64), next_clock
+
+
+_lean_state = {}
+
+
+def _init_lean_worker(G: RetimingGraph):
+    succ, h = wd.reduced_adjacency(G)
+    _lean_state.update(G=G, succ=succ, h=h)
+
+
+def _lean_rows(job):
+    (start, stop), c = job
+    return _lean_constraints(_lean_state['G'], _lean_state['succ'], _lean_state['h'], c, range(start, stop))
+
+
+def OPT_1_LEAN(G, verbose=False, n_jobs=1, block_rows=256, budget=None, state=None, tracer=None):
+    # OPT_1 without W and D: the constraints of each clock come from bounded searches, so the
+    # memory is O(V + E + constraints) instead of O(V^2). The sources are spread over n_jobs
+    # processes. Without D the candidate clocks are not known, the search bisects the integer
+    # clocks between the bounds instead: a not feasible clock c raises the lower bound to the
+    # smallest D(u, v) > c, a feasible one lowers the upper bound to the clock of its retiming.
+    # budget and state as in OPT_1.
+    RG, is_nx = as_retiming_graph(G)
+    n = RG.n_nodes
+    blocks = wd.row_blocks(n, block_rows)
+    deadline = _deadline(budget)
+
+    if n_jobs == 1:
+        _init_lean_worker(RG)
+        executor = None
+    else:
+        # Every worker builds its own adjacency once, for all the probes
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_lean_worker,
+                                                          initargs=(RG,))
+
+    with tracing.span(tracer, 'OPT_1_LEAN', nodes=n, edges=RG.n_edges, jobs=n_jobs):
+        lo, hi = clock_bounds(RG)
+        best_r = None
+        if state is not None:
+            state.check(RG)
+            if state.lower is not None:
+                lo = max(lo, state.lower)
+            if state.r is not None:
+                hi, best_r = min(hi, state.upper), state.r
+
+        try:
+            while lo < hi:
+                if deadline is not None and time.monotonic() >= deadline:
+                    _out_of_time(lo, hi, verbose, state)
+                    break
+                c = (lo + hi) // 2
+                with tracing.span(tracer, 'probe', c=c) as args:
+                    jobs = [(block, c) for block in blocks]
+                    parts = list(map(_lean_rows, jobs) if executor is None else executor.map(_lean_rows, jobs))
+                    x, y, w_xy, next_clocks = zip(*parts)
+                    src, dst, weight = bellman_ford.difference_constraints(n,
+                                                                           np.concatenate(x + (RG.edge_src,)),
+                                                                           np.concatenate(y + (RG.edge_dst,)),
+                                                                           np.concatenate(w_xy + (RG.edge_w,)))
+                    args['constraint_edges'] = src.size
+                    r = bellman_ford.solve(n, src, dst, weight, initial=best_r, stats=args)
+                    args['feasible'] = r is not None
+                _trace_probe(tracer, c, args)
+
+                if verbose:
+                    print(f"Clock {c} {'is' if r is not None else 'is NOT'} feasible")
+
+                if r is None:
+                    lo = min(clock for clock in next_clocks if clock is not None)
                 else:
-                    bellman_ford_solver_graph.add_edge(v, u, w=w)
-
-            # print(len(G.edges))
-            # print(len(indices[0]))
-            # print(len(bellman_ford_solver_graph.edges))
-
-            # graph_utils.print_graph(bellman_ford_solver_graph)
-            bellman_ford_solver_graph.add_node('root_node')
-            for node in G.nodes:
-                bellman_ford_solver_graph.add_edge('root_node', node, w=0)
-            # break
-            # graph_utils.draw_graph(bellman_ford_solver_graph)
-            tested_c.add(c)
-
-            # Solve the graph
-            is_feasible = True
-            try:
-                # graph_utils.draw_graph(bellman_ford_solver_graph)
-                r = nx.single_source_bellman_ford_path_length(bellman_ford_solver_graph, 'root_node', weight='w')
-                # print(r)
-            except nx.NetworkXUnbounded:
-                is_feasible = False
-
-            if verbose:
-                print(f"Clock {c} {'is' if is_feasible else 'is NOT'} feasible")
-
-            if is_feasible:
-                if best_c > c:
-                    best_c = c
                     best_r = r
+                    hi = int(zero_register_delta(RG, RG.edge_w + r[RG.edge_dst] - r[RG.edge_src]).max())
+        finally:
+            if executor is None:
+                _lean_state.clear()
+            else:
+                executor.shutdown()
+
+        if state is not None:
+            state.lower, state.upper, state.r = lo, hi, best_r
+
+    return _retimed(G, RG, np.zeros(n, dtype=np.int64) if best_r is None else best_r, is_nx)
+
+
+def _topological_order(G: RetimingGraph, zero):
+    # Topological order of the subgraph of the zero weight edges (Kahn algorithm)
+    src = G.edge_src[zero].tolist()
+    dst = G.edge_dst[zero].tolist()
+    succ = [[] for _ in range(G.n_nodes)]
+    in_degree = [0] * G.n_nodes
+    for u, v in zip(src, dst):
+        succ[u].append(v)
+        in_degree[v] += 1
+    order = [v for v in range(G.n_nodes) if in_degree[v] == 0]
+    for u in order:
+        for v in succ[u]:
+            in_degree[v] -= 1
+            if in_degree[v] == 0:
+                order.append(v)
+
+    if len(order) != G.n_nodes:
+        raise ValueError("the graph contains a cycle without registers")
+    return np.array(order, dtype=np.int64)
+
+
+def _delta_in_order(G: RetimingGraph, zero, rank, delta):
+    # DELTA of every vertex given a topological order (rank) of the zero weight subgraph:
+    # visiting the zero weight edges by rank of their source, every edge entering u is
+    # relaxed before the edges leaving u
+    edges = np.flatnonzero(zero)
+    edges = edges[np.argsort(rank[G.edge_src[edges]], kind='stable')]
+    delays = G.delays.tolist()
+    path = list(delays)
+    for u, v in zip(G.edge_src[edges].tolist(), G.edge_dst[edges].tolist()):
+        if path[u] + delays[v] > path[v]:
+            path[v] = path[u] + delays[v]
+    delta[:] = path
+    return delta
 
-        else:
-            is_feasible = c >= best_c
 
-        # Move the index
-        binary_search_step = binary_search_step / 2
-        if is_feasible:
-            binary_search_index = binary_search_index - math.ceil(binary_search_step)
+class _DeltaWorklist:
+    # DELTA kept across the FEAS iterations: when some zero weight edges appear or disappear,
+    # only their targets and the zero weight descendants of the vertices whose DELTA changes
+    # are recomputed, in topological order (a heap of the vertex ranks).
+
+    def __init__(self, G: RetimingGraph, zero, delta):
+        self.delays = G.delays.tolist()
+        self.zero = zero.tolist()
+        self.delta = delta.tolist()
+        self.in_edges = [list(zip(G.edge_src[G.in_edges[G.in_ptr[v]:G.in_ptr[v + 1]]].tolist(),
+                                  G.in_edges[G.in_ptr[v]:G.in_ptr[v + 1]].tolist())) for v in range(G.n_nodes)]
+        self.out_edges = [list(zip(G.edge_dst[G.out_edges[G.out_ptr[u]:G.out_ptr[u + 1]]].tolist(),
+                                   G.out_edges[G.out_ptr[u]:G.out_ptr[u + 1]].tolist())) for u in range(G.n_nodes)]
+
+    def update(self, edges, zero, seeds, rank, delta):
+        # edges changed their zero flag, seeds are their targets
+        for e, z in zip(edges.tolist(), zero[edges].tolist()):
+            self.zero[e] = z
+        rank = rank.tolist()
+        path = self.delta
+        worklist = [(rank[v], v) for v in seeds.tolist()]
+        heapq.heapify(worklist)
+        queued = set(seeds.tolist())
+        while worklist:
+            _, v = heapq.heappop(worklist)
+            queued.discard(v)
+            value = self.delays[v]
+            for u, e in self.in_edges[v]:
+                if self.zero[e] and path[u] + self.delays[v] > value:
+                    value = path[u] + self.delays[v]
+            if value != path[v]:
+                path[v] = value
+                for x, e in self.out_edges[v]:
+                    if self.zero[e] and x not in queued:
+                        queued.add(x)
+                        heapq.heappush(worklist, (rank[x], x))
+        delta[:] = path
+        return delta
+
+
+def _feas(G: RetimingGraph, c: int, propagation='worklist', stats=None, abort=None):
+    # abort as in bellman_ford.solve: checked between two iterations, None once it returns True
+    n = G.n_nodes
+    r = np.zeros(n, dtype=np.int64)
+
+    # Retimed edge weights and zero weight edges, updated in place
+    edge_w = G.edge_w.copy()
+    zero = edge_w == 0
+    delta = np.empty(n, dtype=np.int64)
+    moved_mask = np.empty(n, dtype=bool)
+
+    # Topological order of the zero weight subgraph and the rank of every vertex in it
+    order = _topological_order(G, zero)
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+
+    _delta_in_order(G, zero, rank, delta)
+    if propagation == 'worklist':
+        worklist = _DeltaWorklist(G, zero, delta)
+    elif propagation != 'full':
+        raise ValueError(f"Unknown propagation {propagation}")
+
+    moves = 0
+    for i in range(n - 1):
+        np.greater(delta, c, out=moved_mask)
+        moved = np.flatnonzero(moved_mask)
+
+        # Nothing moves anymore: the following iterations would not change r
+        if moved.size == 0:
+            if stats is not None:
+                stats.update(iterations=i, moves=moves)
+            return r
+        if abort is not None and abort():
+            return None
+        r[moved] += 1
+        moves += moved.size
+
+        # Move the registers, only the edges around the moved vertices change
+        changed = np.concatenate([G.out_edges_of(moved), G.in_edges_of(moved)])
+        edge_w[changed] = G.edge_w[changed] + r[G.edge_dst[changed]] - r[G.edge_src[changed]]
+        flipped = changed[zero[changed] != (edge_w[changed] == 0)]
+        zero[flipped] = ~zero[flipped]
+
+        # The zero weight edges between moved and not moved vertices now go from the moved ones
+        # to the others: moving the moved vertices first, in the same order, keeps a topological order
+        order = np.concatenate([order[moved_mask[order]], order[~moved_mask[order]]])
+        rank[order] = np.arange(n)
+
+        # Recompute DELTA: from scratch, or only where a zero weight edge appeared or disappeared
+        if propagation == 'full':
+            _delta_in_order(G, zero, rank, delta)
         else:
-            binary_search_index = binary_search_index + math.ceil(binary_search_step)
-    Gr = graph_utils.retime_graph(G, best_r)
-
-    return Gr
-
+            worklist.update(flipped, zero, np.unique(G.edge_dst[flipped]), rank, delta)
 
-def FEAS(G: nx.DiGraph, c: int):
-    r = dict(zip(G.nodes, [0 for _ in G.nodes]))
-
-    # Clone the graph
-    Gr = copy.deepcopy(G)
-
-    for i in range(len(Gr.nodes) - 1):
-        path = CP(Gr)
-        for node in Gr.nodes:
-            if path.get(node, 0) > c:
-                r[node] = r[node] + 1
-        # Move the registers
-        for u, v in list(Gr.edges):
-            Gr[u][v]['w'] = G[u][v]['w'] + r[v] - r[u]
-    if max(CP(Gr).values()) > c:
+    if stats is not None:
+        stats.update(iterations=n - 1, moves=moves)
+    if delta.max() > c:
         return None
     else:
-        return Gr
-
-def OPT_2(G: nx.DiGraph, D: np.matrix, verbose=False):
+        return r
 
-    tested_c = set([])
-    best_c = np.inf
 
-    # Initialize binary search data structure
-    binary_search_array = np.array(sorted(D.flat))
-    binary_search_array = np.unique(binary_search_array)
-    binary_search_step = int(binary_search_array.size / 2)
-    binary_search_index = binary_search_step
+def _traced_feas(G: RetimingGraph, c, propagation, tracer):
+    with tracing.span(tracer, 'FEAS', c=int(c), propagation=propagation) as args:
+        r = _feas(G, c, propagation, args if tracer is not None else None)
+        args['feasible'] = r is not None
+    _trace_probe(tracer, c, args)
+    return r
 
-    Gr = copy.deepcopy(G)
 
-    # Binary search
-    for _ in range(math.ceil(math.log2(binary_search_array.size)) + 1):
-
-        # Check exit condition:
-        if binary_search_index >= len(binary_search_array) or binary_search_index < 0:
-            break
-
-        # Retrieve a clock and try it if feasible
-        c = binary_search_array[binary_search_index]
-
-        if c not in tested_c:
-
-            FEAS_result = FEAS(G, c)
-
-            # Solve the graph
-            is_feasible = FEAS_result is not None
+def FEAS(G, c: int, propagation='worklist', tracer=None):
+    RG, is_nx = as_retiming_graph(G)
+    r = _traced_feas(RG, c, propagation, tracer)
+    if r is None:
+        return None
+    return _retimed(G, RG, r, is_nx)
 
-            if verbose:
-                print(f"Clock {c} {'is' if is_feasible else 'is NOT'} feasible")
-            tested_c.add(c)
 
-            if is_feasible:
-                if best_c > c:
-                    best_c = c
-                    Gr = FEAS_result
+def OPT_2(G, D: np.ndarray, verbose=False, tile_budget=wd.DEFAULT_TILE_BUDGET, propagation='worklist', n_jobs=1,
+          cache=None, budget=None, state=None, tracer=None):
+    # budget and state as in OPT_1
+    RG, is_nx = as_retiming_graph(G)
+    deadline = _deadline(budget)
+    if state is not None:
+        state.check(RG)
 
-        else:
-            is_feasible = c >= best_c
+    with tracing.span(tracer, 'OPT_2', nodes=RG.n_nodes, edges=RG.n_edges, jobs=n_jobs):
+        with tracing.span(tracer, 'candidate_clocks') as args:
+            candidates = candidate_clocks(RG, D, tile_budget, cache)
+            args['candidates'] = candidates.size
 
-        # Move the index
-        binary_search_step = binary_search_step / 2
-        if is_feasible:
-            binary_search_index = binary_search_index - math.ceil(binary_search_step)
+        if n_jobs > 1:
+            best_r = _parallel_search(candidates, n_jobs, ('OPT_2', RG, None, None, tile_budget, propagation),
+                                      verbose, state, deadline)
         else:
-            binary_search_index = binary_search_index + math.ceil(binary_search_step)
-
-
-    return Gr
\ No newline at end of file
+            best_r = _binary_search(candidates, lambda c, best_r: _traced_feas(RG, c, propagation, tracer), verbose,
+                                    state, deadline)
+
+    return _retimed(G, RG, np.zeros(RG.n_nodes, dtype=np.int64) if best_r is None else best_r, is_nx)
+
+
+def OPT_3(G, W: np.ndarray, D: np.ndarray, verbose=False, tile_budget=wd.DEFAULT_TILE_BUDGET):
+    RG, is_nx = as_retiming_graph(G)
+
+    # Parametric sweep: the constraints are added by decreasing D, the clock goes down from the
+    # clock of G to the next value of D every time a group of constraints with the same D is in.
+    # The retiming is kept feasible from one group to the next (IncrementalSolution), so a group
+    # costs only the propagation of the constraints it violates. The first group that closes a
+    # negative cycle gives the minimum clock, no binary search. All the constraints of the
+    # clocks above the maximum delay are kept in memory: with W and D out of core, use OPT_1.
+    lower, _ = clock_bounds(RG)
+    constraints = PeriodConstraints(RG, W, D, lower, tile_budget)
+    solution = bellman_ford.IncrementalSolution(RG.n_nodes, constraints.src, constraints.dst, constraints.weight)
+    # r = 0 satisfies the constraints of the circuit edges
+    solution.add(RG.n_edges)
+
+    # Ends of the groups of constraints with the same D. The groups that the retiming already
+    # satisfies are added at once: the next group to propagate is the one of the first violated
+    # constraint.
+    delays = constraints.delays
+    stops = np.append(np.flatnonzero(delays[1:] != delays[:-1]) + 1, delays.size)
+    best_c = lower
+    while solution.size < constraints.src.size:
+        first = solution.first_violated(constraints.src.size) - RG.n_edges
+        stop = int(stops[np.searchsorted(stops, first, side='right')]) if first < delays.size else delays.size
+        if not solution.add(RG.n_edges + stop):
+            best_c = int(delays[first])
+            break
+        if verbose:
+            print(f"Clock {delays[stop] if stop < delays.size else lower} is feasible")
+
+    if verbose:
+        print(f"Clock {best_c} is the minimum clock")
+
+    return _retimed(G, RG, solution.dist, is_nx)
+
+
+def _area_constraints(G: RetimingGraph, W, D, c, tile_budget=wd.DEFAULT_TILE_BUDGET):
+    # Pairs (x, y) with D(x, y) > c and their bound W(x, y) - 1, without the redundant ones:
+    # the pair is implied by an edge x -> z and the pair (z, y) when a minimum weight path
+    # from x to y starts with that edge and D(z, y) > c
+    x, y, w_xy = [[np.empty(0, dtype=np.int64)] for _ in range(3)]
+    chunk = wd.rows_per_block(G.n_nodes, tile_budget, 4)
+    for start, W_block, D_block in wd.iter_row_blocks(W, D, tile_budget=tile_budget):
+        keep = D_block > c
+        edges = G.out_edges_of(np.arange(start, start + W_block.shape[0]))
+
+        # The edges are grouped by source, each group is reduced with a single reduceat
+        for i in range(0, edges.size, chunk):
+            e = edges[i:i + chunk]
+            rows = G.edge_src[e] - start
+            z = G.edge_dst[e]
+            implied = (np.asarray(D[z]) > c) & (W_block[rows] - G.edge_w[e][:, None] == np.asarray(W[z]))
+            starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+            keep[rows[starts]] &= ~np.logical_or.reduceat(implied, starts, axis=0)
+
+        rows, cols = np.nonzero(keep)
+        x.append(rows + start)
+        y.append(cols)
+        w_xy.append(W_block[rows, cols] - 1)
+    return np.concatenate(x), np.concatenate(y), np.concatenate(w_xy)
+
+
+def MIN_AREA(G, W: np.ndarray, D: np.ndarray, c=None, verbose=False, tile_budget=wd.DEFAULT_TILE_BUDGET):
+    RG, is_nx = as_retiming_graph(G)
+    n = RG.n_nodes
+
+    # Without a clock, minimize the registers of the minimum clock
+    if c is None:
+        c = int(CP(OPT_1(RG, W, D, tile_budget=tile_budget)).max())
+
+    # Constraints: r(x) - r(y) <= W(x, y) - 1 and r(u) - r(v) <= w(e)
+    x, y, w_xy = _area_constraints(RG, W, D, c, tile_budget)
+    src, dst, weight = bellman_ford.difference_constraints(n,
+                                                           np.concatenate([x, RG.edge_src]),
+                                                           np.concatenate([y, RG.edge_dst]),
+                                                           np.concatenate([w_xy, RG.edge_w]))
+    r = bellman_ford.solve(n, src, dst, weight)
+    if r is None:
+        raise ValueError(f"Clock {c} is not feasible")
+
+    # The registers of the retimed graph are sum(w) + sum((indegree(v) - outdegree(v)) * r(v)).
+    # The dual of this LP is a min cost flow on the constraint graph: every node v supplies
+    # indegree(v) - outdegree(v) units and the cost of a unit on an edge is its bound.
+    supply = np.bincount(RG.edge_dst, minlength=n) - np.bincount(RG.edge_src, minlength=n)
+    F = nx.DiGraph()
+    F.add_nodes_from((v, {'demand': -s}) for v, s in enumerate(supply.tolist()))
+    F.add_weighted_edges_from(zip(src.tolist(), dst.tolist(), weight.tolist()))
+    cost, flow = nx.network_simplex(F)
+
+    if verbose:
+        print(f"Clock {c}: {src.size} constraints, {int(RG.edge_w.sum()) - cost} registers")
+
+    # Complementary slackness: the constraints with a positive flow are tight in an optimal
+    # retiming, which is then any solution of the constraints plus their reverse edges
+    tight = np.array([flow[u][v] > 0 for u, v in zip(src.tolist(), dst.tolist())], dtype=bool)
+    r = bellman_ford.solve(n,
+                           np.concatenate([src, dst[tight]]),
+                           np.concatenate([dst, src[tight]]),
+                           np.concatenate([weight, -weight[tight]]),
+                           initial=r)
+    return _retimed(G, RG, r, is_nx)
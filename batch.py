@@ -0,0 +1,259 @@
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+import algorithm
+import circuit_io
+import graph_utils
+import verify
+import wd_cache
+from retiming_graph import retiming_vector
+
+FIELDS = ['file', 'nodes', 'edges', 'clock', 'registers', 'retimed clock', 'retimed registers', 'legal',
+          'parse time', 'wd time', 'optimize time', 'verify time', 'error']
+
+
+def list_circuits(pattern):
+    # Every file of a directory, or the files matching a glob pattern
+    if os.path.isdir(pattern):
+        paths = (os.path.join(pattern, name) for name in os.listdir(pattern))
+        return sorted(path for path in paths if os.path.isfile(path))
+    return sorted(glob.glob(pattern))
+
+
+def read_results(filename):
+    # Results already written, the last line is dropped if it was cut by an interruption
+    if not os.path.exists(filename):
+        return []
+    rows = []
+    with open(filename, newline='') as f:
+        if filename.endswith('.csv'):
+            lines = f.read().splitlines(keepends=True)
+            if lines and not lines[-1].endswith('\n'):
+                lines.pop()
+            rows = list(csv.DictReader(lines))
+        else:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    break
+    return rows
+
+
+def parse_worker(paths, graphs, results):
+    # Stage 1: read and preprocess the circuits, the bounded graphs queue keeps the stage from
+    # running too far ahead of the solvers
+    for path in iter(paths.get, None):
+        # The binary circuit files are memory mapped by the solvers themselves, not copied through the queue
+        if path.endswith(circuit_io.EXTENSION):
+            graphs.put((path, None, 0.0))
+            continue
+        start = time.time()
+        try:
+            G = graph_utils.preprocess(graph_utils.load_graph(path))
+        except Exception as e:
+            results.put({'file': path, 'error': repr(e)})
+            continue
+        graphs.put((path, G, time.time() - start))
+
+
+def solve_worker(graphs, results, options):
+    # Stages 2 to 4: W and D, the optimization and the check of the retimed graph
+    cache = None if options['cache_dir'] is None else wd_cache.WDCache(options['cache_dir'])
+    tile_budget = options['tile_budget']
+
+    for path, G, parse_time in iter(graphs.get, None):
+        result = {'file': path}
+        try:
+            if G is None:
+                start = time.time()
+                G = graph_utils.load_graph(path)
+                parse_time = time.time() - start
+            result.update({'nodes': G.n_nodes, 'edges': G.n_edges, 'parse time': parse_time})
+
+            start = time.time()
+            W, D = algorithm.WD(G, method=options['wd_method'], tile_budget=tile_budget, cache=cache)
+            result['wd time'] = time.time() - start
+
+            start = time.time()
+            if options['algorithm'] == 'opt_1':
+                Gr = algorithm.OPT_1(G, W, D, tile_budget=tile_budget, cache=cache)
+            elif options['algorithm'] == 'opt_2':
+                Gr = algorithm.OPT_2(G, D, tile_budget=tile_budget, cache=cache)
+            elif options['algorithm'] == 'opt_3':
+                Gr = algorithm.OPT_3(G, W, D, tile_budget=tile_budget)
+            else:
+                Gr = algorithm.MIN_AREA(G, W, D, tile_budget=tile_budget)
+            result['optimize time'] = time.time() - start
+
+            start = time.time()
+            report = verify.verify(G, Gr)
+            result['clock'] = report['original clock']
+            result['registers'] = report['original registers']
+            result['retimed clock'] = report['clock']
+            result['retimed registers'] = report['registers']
+            result['legal'] = report['legal']
+            result['verify time'] = time.time() - start
+
+            if options['retiming_dir'] is not None:
+                r = retiming_vector(G, Gr)
+                name = os.path.basename(path) + circuit_io.EXTENSION
+                circuit_io.write_circuit(os.path.join(options['retiming_dir'], name), r=r, node_names=G.node_names)
+        except Exception as e:
+            result['error'] = repr(e)
+        results.put(result)
+
+
+def writer(results, filename, append):
+    # The only process that writes the output: one line per circuit, flushed as soon as it is ready
+    is_csv = filename.endswith('.csv')
+    with open(filename, 'a' if append else 'w', newline='') as f:
+        if is_csv:
+            csv_writer = csv.DictWriter(f, fieldnames=FIELDS)
+            if not append or f.tell() == 0:
+                csv_writer.writeheader()
+        for result in iter(results.get, None):
+            if is_csv:
+                csv_writer.writerow(result)
+            else:
+                f.write(json.dumps(result) + '\n')
+            f.flush()
+
+
+def run_batch(paths, output_file, parse_jobs, solve_jobs, queue_size, options, append=False):
+    path_queue = multiprocessing.Queue()
+    graph_queue = multiprocessing.Queue(maxsize=queue_size)
+    result_queue = multiprocessing.Queue()
+
+    writer_process = multiprocessing.Process(target=writer, args=(result_queue, output_file, append))
+    parsers = [multiprocessing.Process(target=parse_worker, args=(path_queue, graph_queue, result_queue))
+               for _ in range(parse_jobs)]
+    solvers = [multiprocessing.Process(target=solve_worker, args=(graph_queue, result_queue, options))
+               for _ in range(solve_jobs)]
+    for process in [writer_process] + parsers + solvers:
+        process.start()
+
+    for path in paths:
+        path_queue.put(path)
+
+    # Each stage ends once the previous one is over: one stop sentinel per worker
+    for _ in parsers:
+        path_queue.put(None)
+    for process in parsers:
+        process.join()
+    for _ in solvers:
+        graph_queue.put(None)
+    for process in solvers:
+        process.join()
+    result_queue.put(None)
+    writer_process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Retime a corpus of circuits')
+
+    parser.add_argument('--input',
+                        action='store',
+                        type=str,
+                        help='directory or glob pattern of the circuits (dot or binary circuit files)',
+                        default='dot')
+
+    parser.add_argument('--output',
+                        action='store',
+                        type=str,
+                        help='output file, CSV if its extension is .csv, JSON lines otherwise',
+                        default='batch_result.jsonl')
+
+    parser.add_argument('--algorithm',
+                        action='store',
+                        type=str,
+                        choices=['opt_1', 'opt_2', 'opt_3', 'min_area'],
+                        help='algorithm used to retime the circuits',
+                        default='opt_1')
+
+    parser.add_argument('--parse-jobs',
+                        action='store',
+                        type=int,
+                        help='number of processes that read and preprocess the circuits',
+                        default=max(1, os.cpu_count() // 4))
+
+    parser.add_argument('--solve-jobs',
+                        action='store',
+                        type=int,
+                        help='number of processes that compute W and D, retime and check the circuits',
+                        default=os.cpu_count())
+
+    parser.add_argument('--queue-size',
+                        action='store',
+                        type=int,
+                        help='maximum number of circuits read and waiting for a solver',
+                        default=2 * os.cpu_count())
+
+    parser.add_argument('--resume',
+                        action='store',
+                        type=bool,
+                        help='if enable, the circuits already in the output file are skipped',
+                        default=False)
+
+    parser.add_argument('--wd-method',
+                        action='store',
+                        type=str,
+                        choices=['auto', 'dense', 'sparse', 'blocked'],
+                        help='engine used to compute W and D',
+                        default='auto')
+
+    parser.add_argument('--tile-budget',
+                        action='store',
+                        type=int,
+                        help='memory budget (MB) of the blocks of W and D held in memory',
+                        default=256)
+
+    parser.add_argument('--cache-dir',
+                        action='store',
+                        type=str,
+                        help='directory of the W and D cache',
+                        default=None)
+
+    parser.add_argument('--retiming-dir',
+                        action='store',
+                        type=str,
+                        help='if set, the retiming vector of each circuit is saved in it (binary circuit file)',
+                        default=None)
+
+    args = parser.parse_args()
+    options = {'algorithm': args.algorithm,
+               'wd_method': args.wd_method,
+               'tile_budget': args.tile_budget * 2 ** 20,
+               'cache_dir': args.cache_dir,
+               'retiming_dir': args.retiming_dir}
+    if args.retiming_dir is not None:
+        os.makedirs(args.retiming_dir, exist_ok=True)
+
+    paths = list_circuits(args.input)
+    append = False
+    if args.resume:
+        # Keep the complete results and skip their circuits, the cut last line and the failed
+        # circuits are removed (and retried)
+        done = [row for row in read_results(args.output) if not row.get('error')]
+        tmp_file = args.output + '.tmp'
+        with open(tmp_file, 'w', newline='') as f:
+            if args.output.endswith('.csv'):
+                csv_writer = csv.DictWriter(f, fieldnames=FIELDS)
+                csv_writer.writeheader()
+                csv_writer.writerows(done)
+            else:
+                f.writelines(json.dumps(row) + '\n' for row in done)
+        os.replace(tmp_file, args.output)
+        completed = {row['file'] for row in done}
+        paths = [path for path in paths if path not in completed]
+        append = True
+
+    print(f"{len(paths)} circuits to retime")
+    start = time.time()
+    run_batch(paths, args.output, args.parse_jobs, args.solve_jobs, args.queue_size, options, append)
+    print(f"Done in {time.time() - start:.2f} s")
@@ -0,0 +1,197 @@
+import math
+
+import numpy as np
+
+# Number of Bellman-Ford rounds between two searches of a cycle in the predecessor graph
+CYCLE_CHECK_INTERVAL = 8
+
+
+def difference_constraints(n, x, y, bound):
+    # The constraint r(x) - r(y) <= bound is the edge y -> x with weight bound,
+    # duplicated constraints are reduced to the tightest one
+    src = np.asarray(y, dtype=np.int64)
+    dst = np.asarray(x, dtype=np.int64)
+    weight = np.asarray(bound, dtype=np.int64)
+    if src.size == 0:
+        return src, dst, weight
+
+    keys = src * n + dst
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    weight = np.minimum.reduceat(weight[order], starts)
+    return src[order][starts], dst[order][starts], weight
+
+
+def has_predecessor_cycle(pred):
+    # pred[v] is the vertex that last improved v (-1 if none): after n jumps every vertex is
+    # either out of the predecessor graph or on one of its cycles
+    n = pred.size
+    jump = np.append(np.where(pred < 0, n, pred), n)
+    for _ in range(max(1, math.ceil(math.log2(n + 1)))):
+        jump = jump[jump]
+    return bool((jump[:n] != n).any())
+
+
+def _finish(stats, rounds, n_edges, result):
+    # Record the number of rounds and of edge relaxations in stats, if given
+    if stats is not None:
+        stats['rounds'] = stats.get('rounds', 0) + rounds
+        stats['relaxations'] = stats.get('relaxations', 0) + rounds * n_edges
+    return result
+
+
+def _by_target(src, dst, weight, grouped=False):
+    # Group the edges by target vertex so that each round is a single reduceat
+    if not grouped:
+        order = np.argsort(dst, kind='stable')
+        src, dst, weight = src[order], dst[order], weight[order]
+    starts = np.flatnonzero(np.r_[True, dst[1:] != dst[:-1]])
+    group = np.repeat(np.arange(starts.size), np.diff(np.r_[starts, dst.size]))
+    return src, dst, weight, starts, group
+
+
+def _relax(dist, pred, src, dst, weight, starts, group):
+    # One round over edges grouped by target vertex, return the vertices that improved
+    targets = dst[starts]
+    candidates = dist[src] + weight
+    best = np.minimum.reduceat(candidates, starts)
+    improved = best < dist[targets]
+    if not improved.any():
+        return targets[improved]
+    dist[targets[improved]] = best[improved]
+
+    # Predecessor of each improved vertex: the source of (one of) its best candidates
+    hits = np.flatnonzero(improved[group] & (candidates == best[group]))
+    pred[dst[hits]] = src[hits]
+    return targets[improved]
+
+
+def solve(n, src, dst, weight, initial=None, stats=None, grouped=False, abort=None):
+    # Vectorized Bellman-Ford from a virtual root linked to every vertex with weight 0 (or with
+    # weight initial[v], e.g. a previous solution to warm start from). Return the shortest
+    # distances, i.e. a solution of the constraints, or None if there is a negative cycle.
+    # With grouped, the edges are already sorted by target vertex. abort() is called between
+    # two rounds: once it returns True the result is no longer needed and None is returned.
+    dist = np.zeros(n, dtype=np.int64) if initial is None else np.array(initial, dtype=np.int64)
+    if src.size == 0:
+        return dist
+
+    edges = _by_target(src, dst, weight, grouped)
+    pred = np.full(n, -1, dtype=np.int64)
+
+    for i in range(n + 1):
+        if not _relax(dist, pred, *edges).size:
+            return _finish(stats, i + 1, src.size, dist)
+        if abort is not None and abort():
+            return _finish(stats, i + 1, src.size, None)
+
+        # Early exit: a cycle of predecessors is a negative cycle
+        if i % CYCLE_CHECK_INTERVAL == CYCLE_CHECK_INTERVAL - 1 and has_predecessor_cycle(pred):
+            return _finish(stats, i + 1, src.size, None)
+
+    return _finish(stats, n + 1, src.size, None)
+
+
+# Bound of a missing constraint in the blocks of solve_rows: dist + NO_BOUND never overflows
+NO_BOUND = 2 ** 62
+
+
+def solve_rows(n, src, dst, weight, row_blocks, initial=None, stats=None, abort=None):
+    # Same as solve, plus dense blocks of constraints read again in every round: row_blocks()
+    # yields (start, bound) where bound[i, y] is the bound of r(start + i) - r(y), or NO_BOUND.
+    # Only one block is in memory at a time. The vertices of a block are updated before the
+    # next block is relaxed, which never takes more rounds than updating them all at the end.
+    dist = np.zeros(n, dtype=np.int64) if initial is None else np.array(initial, dtype=np.int64)
+    edges = _by_target(src, dst, weight) if src.size else None
+    pred = np.full(n, -1, dtype=np.int64)
+
+    for i in range(n + 1):
+        improved_any = edges is not None and _relax(dist, pred, *edges).size > 0
+        for start, bound in row_blocks():
+            candidates = bound + dist[np.newaxis, :]
+            arg = candidates.argmin(axis=1)
+            best = candidates[np.arange(arg.size), arg]
+            improved = np.flatnonzero(best < dist[start:start + arg.size])
+            if improved.size:
+                dist[start + improved] = best[improved]
+                pred[start + improved] = arg[improved]
+                improved_any = True
+        if not improved_any:
+            return _finish(stats, i + 1, src.size + n * n, dist)
+        if abort is not None and abort():
+            return _finish(stats, i + 1, src.size + n * n, None)
+
+        if i % CYCLE_CHECK_INTERVAL == CYCLE_CHECK_INTERVAL - 1 and has_predecessor_cycle(pred):
+            return _finish(stats, i + 1, src.size + n * n, None)
+
+    return _finish(stats, n + 1, src.size + n * n, None)
+
+
+class IncrementalSolution:
+    # Solution of a constraint graph whose edges are added in the order of the arrays, kept
+    # from one addition to the next. An addition relaxes only the new edges that the solution
+    # violates, then the edges leaving the vertices that improved, a round at a time: its cost
+    # follows the vertices whose distance changes, not the size of the graph.
+
+    def __init__(self, n, src, dst, weight):
+        self.src = src
+        self.dst = dst
+        self.weight = weight
+        self.dist = np.zeros(n, dtype=np.int64)
+        self.size = 0
+        # The edges grouped by source, in the order of addition in each group: the edges of a
+        # source already in the graph are the first n_out[u] ones of its group
+        self.out = np.argsort(src, kind='stable')
+        self.ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self.ptr[1:])
+        self.n_out = np.zeros(n, dtype=np.int64)
+
+    def _out_edges(self, nodes):
+        counts = self.n_out[nodes]
+        ends = np.cumsum(counts)
+        positions = np.repeat(self.ptr[nodes] - ends + counts, counts) + np.arange(ends[-1] if ends.size else 0)
+        return self.out[positions]
+
+    def first_violated(self, stop):
+        # Position of the first edge not in the graph yet, before stop, that the solution
+        # violates (stop if none), scanning chunks that double in size
+        start, chunk = self.size, 1024
+        while start < stop:
+            end = min(stop, start + chunk)
+            src, dst = self.src[start:end], self.dst[start:end]
+            violated = np.flatnonzero(self.dist[src] + self.weight[start:end] < self.dist[dst])
+            if violated.size:
+                return start + int(violated[0])
+            start, chunk = end, 2 * chunk
+        return stop
+
+    def add(self, stop):
+        # Add the edges up to stop. Return False and leave the graph and the solution unchanged
+        # if they close a negative cycle.
+        n = self.dist.size
+        new = slice(self.size, stop)
+        added = np.bincount(self.src[new], minlength=n)
+        self.n_out += added
+        edges = self.size + np.flatnonzero(self.dist[self.src[new]] + self.weight[new] < self.dist[self.dst[new]])
+        dist = self.dist.copy() if edges.size else self.dist
+        pred = np.full(n, -1, dtype=np.int64) if edges.size else None
+        for i in range(n + 1):
+            if not edges.size:
+                break
+            if i == n or (i % CYCLE_CHECK_INTERVAL == CYCLE_CHECK_INTERVAL - 1 and has_predecessor_cycle(pred)):
+                self.n_out -= added
+                return False
+            # Few edges per round: only the candidates that improve their target are applied
+            src, dst = self.src[edges], self.dst[edges]
+            candidates = dist[src] + self.weight[edges]
+            better = np.flatnonzero(candidates < dist[dst])
+            src, dst, candidates = src[better], dst[better], candidates[better]
+            np.minimum.at(dist, dst, candidates)
+            hits = candidates == dist[dst]
+            pred[dst[hits]] = src[hits]
+            edges = self._out_edges(np.unique(dst))
+
+        self.dist = dist
+        self.size = stop
+        return True
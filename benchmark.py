@@ -0,0 +1,537 @@
+import argparse
+import json
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import algorithm
+import dot_io
+import gen_circuits
+import graph_utils
+import wd
+from retiming_graph import as_retiming_graph
+
+# Seeded circuit families: the generator and the parameters of each case
+FAMILIES = {
+    'correlator': (gen_circuits.gen_correlator, [{'n_bit': n} for n in (8, 16, 32, 64)]),
+    'tree': (gen_circuits.gen_tree, [{'depth': depth, 'n_branch': 3, 'delay': 100, 'random_delays': True}
+                                     for depth in (3, 4, 5)]),
+    'full_graph': (gen_circuits.gen_full_graph, [{'nodes': n, 'delay': 100, 'random_delays': True}
+                                                 for n in (25, 50, 100, 200)]),
+}
+
+PHASES = ['parse', 'preprocess', 'wd', 'candidates', 'constraints', 'search', 'retime']
+
+
+def case_name(family, params):
+    return family + ' ' + ' '.join(f"{key}={value}" for key, value in params.items())
+
+
+def list_cases(families):
+    return [{'name': case_name(family, params), 'family': family, 'params': params}
+            for family in families for params in FAMILIES[family][1]]
+
+
+def _solver(RG, W, D, candidates, algorithm_name):
+    # Probe of the binary search: OPT_1 sorts its constraints once, OPT_2 runs FEAS
+    if algorithm_name == 'opt_1':
+        constraints = algorithm.PeriodConstraints(RG, W, D, candidates[0])
+        return lambda c, best_r: constraints.solve(c, initial=best_r)
+    return lambda c, best_r: algorithm._feas(RG, c)
+
+
+def run_phases(path, algorithm_name, wd_method, measure, wrap_probe=lambda solve: solve):
+    # The retiming of the circuit in path, measure(phase, function) runs each phase and returns its result
+    RG = measure('parse', lambda: dot_io.read_dot(path))
+    RG = measure('preprocess', lambda: graph_utils.preprocess(RG))
+    W, D = measure('wd', lambda: algorithm.WD(RG, method=wd_method))
+    candidates = measure('candidates', lambda: algorithm.candidate_clocks(RG, D))
+    solve = wrap_probe(measure('constraints', lambda: _solver(RG, W, D, candidates, algorithm_name)))
+    best_r = measure('search', lambda: algorithm._binary_search(candidates, solve))
+    return measure('retime', lambda: RG.retime(np.zeros(RG.n_nodes, dtype=np.int64) if best_r is None else best_r))
+
+
+def _case_circuit(case, seed, directory):
+    # The seeded circuit of the case, saved as a DOT file: the parse phase reads it as the scripts do
+    generator = FAMILIES[case['family']][0]
+    random.seed(seed)
+    path = os.path.join(directory, 'circuit.dot')
+    dot_io.write_dot(generator(**case['params']), path)
+    return path
+
+
+def _case_result(case, Gr, **values):
+    return dict({'name': case['name'], 'family': case['family'], 'params': case['params'],
+                 'nodes': Gr.n_nodes, 'edges': Gr.n_edges, 'clock': int(algorithm.CP(Gr).max())}, **values)
+
+
+def time_phases(case, algorithm_name, repeats, seed, wd_method, warmup=1):
+    # Every phase of the retiming of the case, timed separately, repeats times after warmup runs
+    # that are not recorded
+    with tempfile.TemporaryDirectory() as directory:
+        path = _case_circuit(case, seed, directory)
+
+        runs = []
+        for i in range(warmup + repeats):
+            phases = {}
+            probes = []
+
+            def measure(phase, function):
+                start = time.perf_counter()
+                result = function()
+                phases[phase] = time.perf_counter() - start
+                return result
+
+            def wrap_probe(solve):
+                # Every probe of the binary search is timed too
+                def probe(c, best_r):
+                    start = time.perf_counter()
+                    r = solve(c, best_r)
+                    probes.append({'clock': int(c), 'feasible': r is not None, 'time': time.perf_counter() - start})
+                    return r
+                return probe
+
+            Gr = run_phases(path, algorithm_name, wd_method, measure, wrap_probe)
+            if i >= warmup:
+                runs.append({'phases': phases, 'probes': probes})
+
+    return _case_result(case, Gr, runs=runs)
+
+
+def thread_scaling(cases, threads, repeats, seed, block_size=wd.BLOCK_SIZE):
+    # Time of the blocked W and D engine with each number of threads: the median of repeats runs,
+    # and the speedup over the first number of threads. Unlike the phases, the cases run in this
+    # process with all its CPUs, and the number of CPUs is reported with the times: more threads
+    # than CPUs only share them.
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    print(f"{cpus} CPUs available")
+    results = []
+    for case in cases:
+        random.seed(seed)
+        RG, _ = as_retiming_graph(graph_utils.preprocess(FAMILIES[case['family']][0](**case['params'])))
+        tiles = len(wd.row_blocks(RG.n_nodes, block_size)) ** 2
+        times = {}
+        for n_threads in threads:
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                wd.blocked(RG, n_threads=n_threads, block_size=block_size)
+                samples.append(time.perf_counter() - start)
+            times[n_threads] = float(np.median(samples))
+        speedups = {n_threads: times[threads[0]] / max(times[n_threads], 1e-12) for n_threads in threads}
+        print(f"{case['name']:45} {tiles:5} tiles " +
+              ' '.join(f"{n_threads}: {times[n_threads]:.3f} s (x{speedups[n_threads]:.2f})" for n_threads in threads))
+        results.append({'name': case['name'], 'nodes': RG.n_nodes, 'edges': RG.n_edges, 'tiles': tiles,
+                        'times': times, 'speedups': speedups})
+    return {'cpus': cpus, 'block_size': block_size, 'results': results}
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets the peak RSS (VmHWM) of the process, Linux only
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    # Peak RSS in bytes: VmHWM on Linux, the peak of the whole process elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def memory_phases(case, algorithm_name, seed, wd_method, **_):
+    # Memory of every phase of the retiming of the case: the peak of the python and numpy
+    # allocations (tracemalloc) above the memory at the start of the phase, the memory the phase
+    # leaves allocated, and the peak RSS of the process during the phase
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = _case_circuit(case, seed, directory)
+        phases = {}
+        rss_reset = True
+
+        def measure(phase, function):
+            nonlocal rss_reset
+            rss_reset = _reset_peak_rss() and rss_reset
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            result = function()
+            end, peak = tracemalloc.get_traced_memory()
+            phases[phase] = {'peak bytes': peak - start, 'retained bytes': end - start, 'peak rss': _peak_rss()}
+            return result
+
+        tracemalloc.start()
+        try:
+            Gr = run_phases(path, algorithm_name, wd_method, measure)
+        finally:
+            tracemalloc.stop()
+
+    # Bytes per node and per edge, to fit the scaling of each phase
+    for memory in phases.values():
+        memory['peak bytes per node'] = memory['peak bytes'] / max(Gr.n_nodes, 1)
+        memory['peak bytes per edge'] = memory['peak bytes'] / max(Gr.n_edges, 1)
+    return _case_result(case, Gr, memory=phases, rss_per_phase=rss_reset)
+
+
+def _worker(connection, cpu, case, process, options):
+    # The case runs alone in a fresh process pinned to one CPU, process is the index of that process
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+    try:
+        measure = memory_phases if options['memory'] else time_phases
+        result = measure(case, **{key: value for key, value in options.items() if key not in ('memory', 'processes')})
+        for run in result.get('runs', []):
+            run['process'] = process
+        connection.send(result)
+    except Exception as e:
+        connection.send({'name': case['name'], 'error': repr(e)})
+    connection.close()
+
+
+def run_isolated(cases, jobs, options):
+    # At most jobs cases at a time, each one in its own process and on its own CPU. Every case runs
+    # in options['processes'] processes, whose runs are merged in a single result.
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else [None] * jobs
+    free = cpus[:max(1, min(jobs, len(cpus)))]
+    context = multiprocessing.get_context('spawn')
+    pending = [(case, process) for process in range(options.get('processes', 1)) for case in cases]
+    running = {}
+    results = {}
+
+    while pending or running:
+        while pending and free:
+            cpu = free.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            case, index = pending.pop(0)
+            process = context.Process(target=_worker, args=(sender, cpu, case, index, options))
+            process.start()
+            sender.close()
+            running[receiver] = (process, cpu, case)
+
+        for receiver in multiprocessing.connection.wait(list(running)):
+            process, cpu, case = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {'name': case['name'], 'error': f"worker exited with code {process.exitcode}"}
+            process.join()
+            free.append(cpu)
+            print(f"{result.get('name')}: {'ERROR ' + result['error'] if 'error' in result else 'done'}")
+
+            # The runs of the other processes of the case are added to its first result, an error wins
+            name = result['name']
+            if name in results and 'runs' in results[name] and 'runs' in result:
+                results[name]['runs'].extend(result['runs'])
+            elif name not in results or 'error' in result:
+                results[name] = result
+
+    return sorted(results.values(), key=lambda result: result['name'])
+
+
+def run_interleaved(baseline, arguments, processes):
+    # The benchmark of the baseline tree and this one run one process at a time in turn (base, new,
+    # new, base, ...), so that a slow drift of the machine shifts both sides alike. arguments are
+    # the command line options given to both scripts. Return the base and the new result files.
+    trees = {'base': os.path.abspath(baseline), 'new': os.path.dirname(os.path.abspath(__file__))}
+    files = {side: {'metadata': None, 'results': {}} for side in trees}
+    for process in range(processes):
+        for side in (('base', 'new') if process % 2 == 0 else ('new', 'base')):
+            with tempfile.TemporaryDirectory() as directory:
+                output = os.path.join(directory, 'results.json')
+                script = os.path.join(trees[side], 'benchmark.py')
+                with open(script) as f:
+                    single = ['--processes', '1'] if "'--processes'" in f.read() else []
+                subprocess.run([sys.executable, script, *arguments, *single, '--output', output], cwd=trees[side],
+                               check=True, stdout=subprocess.DEVNULL)
+                with open(output) as f:
+                    data = json.load(f)
+            files[side]['metadata'] = data['metadata']
+            for result in data['results']:
+                for run in result.get('runs', []):
+                    run['process'] = process
+                merged = files[side]['results'].setdefault(result['name'], result)
+                if merged is not result and 'runs' in merged and 'runs' in result:
+                    merged['runs'].extend(result['runs'])
+            print(f"{side} process {process + 1}/{processes} done")
+    for data in files.values():
+        data['results'] = sorted(data['results'].values(), key=lambda result: result['name'])
+    return files['base'], files['new']
+
+
+def metadata(options):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(options, python=sys.version.split()[0], numpy=np.__version__, platform=platform.platform(),
+                commit=commit, date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def phase_samples(result):
+    # Time of every phase (and of all the probes together): the median of the runs of each process,
+    # the runs of a process share its memory layout and are not independent samples
+    groups = {}
+    for i, run in enumerate(result['runs']):
+        groups.setdefault(run.get('process', i), []).append(run)
+    samples = {phase: [float(np.median([run['phases'][phase] for run in runs])) for runs in groups.values()]
+               for phase in PHASES}
+    samples['probes'] = [float(np.median([sum(probe['time'] for probe in run['probes']) for run in runs]))
+                         for runs in groups.values()]
+    return samples
+
+
+def _u_counts(m, n):
+    # Number of orderings of m new and n base samples for each value of U, the number of pairs where
+    # the new sample is the larger: the largest sample is either a new one (U grows by n) or a base one
+    counts = [[np.ones(1, dtype=float)] * (n + 1)]
+    for i in range(1, m + 1):
+        row = [np.ones(1, dtype=float)]
+        for j in range(1, n + 1):
+            f = np.zeros(i * j + 1)
+            f[j:] += counts[i - 1][j]
+            f[:row[j - 1].size] += row[j - 1]
+            row.append(f)
+        counts.append(row)
+    return counts[m][n]
+
+
+def mann_whitney(base, new):
+    # One sided Mann-Whitney U test: p value of new being slower than base, exact without ties,
+    # normal approximation (with the tie correction) otherwise or for large samples
+    base = np.asarray(base, dtype=float)
+    new = np.asarray(new, dtype=float)
+    m, n = new.size, base.size
+    u = float(np.sum(new[:, None] > base[None, :]) + 0.5 * np.sum(new[:, None] == base[None, :]))
+    samples = np.concatenate([base, new])
+    if np.unique(samples).size == samples.size and m * n <= 2500:
+        counts = _u_counts(m, n)
+        return float(counts[int(u):].sum() / counts.sum())
+    _, ties = np.unique(samples, return_counts=True)
+    variance = m * n / 12 * (m + n + 1 - np.sum(ties ** 3 - ties) / ((m + n) * (m + n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - 0.5 - m * n / 2) / np.sqrt(variance)
+    return float(0.5 * math.erfc(z / math.sqrt(2)))
+
+
+def holm(p_values, alpha):
+    # Holm-Bonferroni: which of the tests are significant, with a family wise error rate of alpha
+    significant = np.zeros(len(p_values), dtype=bool)
+    for k, i in enumerate(np.argsort(p_values, kind='stable')):
+        if p_values[i] >= alpha / (len(p_values) - k):
+            break
+        significant[i] = True
+    return significant
+
+
+def compare(base_file, new_file, threshold=0.05, min_time=0.01, alpha=0.05):
+    # A phase regresses when its new times are significantly larger (one sided Mann-Whitney tests,
+    # Holm corrected over all the compared phases at level alpha) and the ratio of the medians is
+    # above 1 + threshold; phases faster than min_time in both files are too noisy to compare.
+    # The samples are the medians of the processes (see phase_samples): with ~50 phases the Holm
+    # correction needs about 10 processes per side.
+    with open(base_file) as f:
+        base = {result['name']: result for result in json.load(f)['results'] if 'runs' in result}
+    with open(new_file) as f:
+        new = {result['name']: result for result in json.load(f)['results'] if 'runs' in result}
+
+    regressions = []
+    rows = []
+    for name in sorted(base.keys() & new.keys()):
+        if base[name]['clock'] != new[name]['clock']:
+            print(f"{name:45} the clock changed from {base[name]['clock']} to {new[name]['clock']}")
+            regressions.append((name, 'clock'))
+        base_samples, new_samples = phase_samples(base[name]), phase_samples(new[name])
+        for phase in base_samples:
+            if max(np.median(base_samples[phase]), np.median(new_samples[phase])) < min_time:
+                continue
+            ratio = np.median(new_samples[phase]) / max(np.median(base_samples[phase]), 1e-12)
+            rows.append((name, phase, ratio, mann_whitney(base_samples[phase], new_samples[phase]),
+                         mann_whitney(new_samples[phase], base_samples[phase])))
+
+    slower = holm([row[3] for row in rows], alpha)
+    faster = holm([row[4] for row in rows], alpha)
+    for (name, phase, ratio, p_slower, p_faster), is_slower, is_faster in zip(rows, slower, faster):
+        if is_slower and ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append((name, phase))
+        elif is_faster and ratio < 1 - threshold:
+            status = 'improvement'
+        else:
+            status = ''
+        print(f"{name:45} {phase:12} {ratio:7.3f} p={min(p_slower, p_faster):.4f} {status}")
+
+    for name in sorted(base.keys() ^ new.keys()):
+        print(f"{name:45} only in {'the base' if name in base else 'the new'} results")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the retiming phases')
+
+    parser.add_argument('--families',
+                        action='store',
+                        type=str,
+                        help='comma separated circuit families: ' + ', '.join(FAMILIES),
+                        default=','.join(FAMILIES))
+
+    parser.add_argument('--algorithm',
+                        action='store',
+                        type=str,
+                        choices=['opt_1', 'opt_2'],
+                        help='algorithm whose search is timed',
+                        default='opt_1')
+
+    parser.add_argument('--wd-method',
+                        action='store',
+                        type=str,
+                        choices=['auto', 'dense', 'sparse', 'blocked'],
+                        help='engine used to compute W and D',
+                        default='auto')
+
+    parser.add_argument('--thread-scaling',
+                        action='store',
+                        type=str,
+                        help='comma separated numbers of threads: the blocked W and D engine is timed with each one '
+                             'instead of the phases',
+                        default=None)
+
+    parser.add_argument('--block-size',
+                        action='store',
+                        type=int,
+                        help='tile size of the blocked engine in the thread scaling runs',
+                        default=wd.BLOCK_SIZE)
+
+    parser.add_argument('--repeats',
+                        action='store',
+                        type=int,
+                        help='number of runs of each case in each process',
+                        default=3)
+
+    parser.add_argument('--processes',
+                        action='store',
+                        type=int,
+                        help='number of fresh processes each case runs in, --repeats runs in each one',
+                        default=10)
+
+    parser.add_argument('--warmup',
+                        action='store',
+                        type=int,
+                        help='number of runs of each case before the recorded ones',
+                        default=1)
+
+    parser.add_argument('--seed',
+                        action='store',
+                        type=int,
+                        help='seed of the random delays of the circuits',
+                        default=0)
+
+    parser.add_argument('--jobs',
+                        action='store',
+                        type=int,
+                        help='number of cases run at the same time, each one pinned to its own CPU',
+                        default=1)
+
+    parser.add_argument('--memory',
+                        action='store',
+                        type=bool,
+                        help='if enable, the memory of each phase is measured instead of its time',
+                        default=False)
+
+    parser.add_argument('--output',
+                        action='store',
+                        type=str,
+                        help='output JSON file',
+                        default='benchmark.json')
+
+    parser.add_argument('--compare',
+                        action='store',
+                        type=str,
+                        nargs=2,
+                        metavar=('BASE', 'NEW'),
+                        help='compare two result files instead of running the benchmark',
+                        default=None)
+
+    parser.add_argument('--baseline',
+                        action='store',
+                        type=str,
+                        help='directory of another tree (e.g. a git worktree): its benchmark and this one run in turn, '
+                             'then they are compared',
+                        default=None)
+
+    parser.add_argument('--threshold',
+                        action='store',
+                        type=float,
+                        help='relative slowdown below which a difference is not reported as a regression',
+                        default=0.05)
+
+    parser.add_argument('--min-time',
+                        action='store',
+                        type=float,
+                        help='phases faster than this (seconds) in both files are not compared',
+                        default=0.01)
+
+    parser.add_argument('--alpha',
+                        action='store',
+                        type=float,
+                        help='family wise significance level of the Mann-Whitney tests of the compared phases',
+                        default=0.05)
+
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        regressions = compare(args.compare[0], args.compare[1], args.threshold, args.min_time, args.alpha)
+        print(f"{len(regressions)} regressions")
+        sys.exit(1 if regressions else 0)
+
+    if args.baseline is not None:
+        # A single process per run of each script, see run_interleaved
+        arguments = ['--families', args.families, '--algorithm', args.algorithm, '--wd-method', args.wd_method,
+                     '--repeats', str(args.repeats), '--warmup', str(args.warmup), '--seed', str(args.seed)]
+        base, new = run_interleaved(args.baseline, arguments, args.processes)
+        base_file = os.path.splitext(args.output)[0] + '_base.json'
+        for filename, data in ((base_file, base), (args.output, new)):
+            with open(filename, 'w') as f:
+                json.dump(data, f, indent=1)
+        regressions = compare(base_file, args.output, args.threshold, args.min_time, args.alpha)
+        print(f"{len(regressions)} regressions")
+        sys.exit(1 if regressions else 0)
+
+    if args.thread_scaling is not None:
+        threads = [int(n_threads) for n_threads in args.thread_scaling.split(',')]
+        scaling = thread_scaling(list_cases(args.families.split(',')), threads, args.repeats, args.seed,
+                                 args.block_size)
+        with open(args.output, 'w') as f:
+            json.dump({'metadata': metadata({'threads': threads, 'repeats': args.repeats, 'seed': args.seed}),
+                       'thread scaling': scaling}, f, indent=1)
+        print(f"The results have been saved in {args.output}")
+        sys.exit(0)
+
+    options = {'algorithm_name': args.algorithm, 'repeats': args.repeats, 'seed': args.seed,
+               'wd_method': args.wd_method, 'warmup': args.warmup, 'memory': args.memory,
+               'processes': 1 if args.memory else args.processes}
+    cases = list_cases(args.families.split(','))
+    results = run_isolated(cases, args.jobs, options)
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': metadata(options), 'results': results}, f, indent=1)
+    print(f"The results have been saved in {args.output}")
@@ -0,0 +1,120 @@
+import collections.abc
+import json
+
+import numpy as np
+
+from retiming_graph import RetimingGraph
+
+# Binary container of a circuit and of its results:
+#   MAGIC | header size (uint64, little endian) | JSON header | arrays
+# The header maps the name of every array to its offset, dtype and shape. The arrays are raw,
+# little endian and 64 bytes aligned, so they are read with a single np.memmap and no parsing:
+# the processes that read the same file share its pages.
+MAGIC = b'RETIMING'
+VERSION = 1
+EXTENSION = '.rtg'
+ALIGNMENT = 64
+_WRITE_BLOCK = 64 * 2 ** 20
+
+_GRAPH_ARRAYS = ('delays', 'edge_src', 'edge_dst', 'edge_w', 'out_ptr', 'out_edges', 'in_ptr', 'in_edges')
+
+
+class NodeNames(collections.abc.Sequence):
+    # Node names stored in the file as '\0' separated UTF-8 bytes and their start offsets: a name
+    # is decoded only when it is used, so loading a circuit does not build millions of strings
+
+    def __init__(self, data, starts):
+        self.data = data
+        self.starts = starts
+
+    def __len__(self):
+        return self.starts.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start = self.starts[i]
+        stop = self.starts[i + 1] - 1 if i + 1 < len(self) and i != -1 else self.data.size
+        return self.data[start:stop].tobytes().decode()
+
+    def __iter__(self):
+        if len(self):
+            yield from self.data.tobytes().decode().split('\0')
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_circuit(filename, G: RetimingGraph = None, W=None, D=None, r=None, node_names=None):
+    # Any of the graph, W, D and the retiming r can be saved, the node names are always saved
+    # (the ones of G if it is given)
+    arrays = {}
+    if G is not None:
+        node_names = G.node_names
+        arrays.update((name, getattr(G, name)) for name in _GRAPH_ARRAYS)
+    assert node_names is not None, "the node names or the graph are required"
+    if isinstance(node_names, NodeNames):
+        arrays['node_names'], arrays['node_starts'] = node_names.data, node_names.starts
+    else:
+        encoded = [str(name).encode() for name in node_names]
+        arrays['node_names'] = np.frombuffer(b'\0'.join(encoded), dtype=np.uint8)
+        lengths = np.fromiter((len(name) + 1 for name in encoded), dtype=np.int64, count=len(encoded))
+        arrays['node_starts'] = np.cumsum(lengths) - lengths
+    for name, a in (('W', W), ('D', D), ('r', r)):
+        if a is not None:
+            arrays[name] = a
+
+    # The offsets are relative to the first aligned byte after the header
+    entries = {}
+    offset = 0
+    for name, a in arrays.items():
+        entries[name] = {'dtype': np.dtype(a.dtype).newbyteorder('<').str, 'shape': list(np.shape(a)), 'offset': offset}
+        offset = _aligned(offset + np.asarray(a).nbytes)
+    header = json.dumps({'version': VERSION, 'arrays': entries}).encode()
+    base = _aligned(len(MAGIC) + 8 + len(header))
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).astype('<u8').tobytes())
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(base + entries[name]['offset'])
+            dtype = entries[name]['dtype']
+            # Large matrices (e.g. memory mapped W and D) are written a block of rows at a time
+            rows = max(1, _WRITE_BLOCK // max(np.asarray(a[:1]).nbytes, 1)) if np.ndim(a) == 2 else None
+            if rows is None:
+                f.write(np.ascontiguousarray(a, dtype=dtype).tobytes())
+            else:
+                for start in range(0, a.shape[0], rows):
+                    f.write(np.ascontiguousarray(a[start:start + rows], dtype=dtype).tobytes())
+        f.truncate(base + offset)
+
+
+def read_circuit(filename):
+    # Dictionary with the node names and, if they are in the file, the graph 'G', 'W', 'D' and
+    # 'r'. The arrays are read only views of a memory mapping of the file.
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a circuit file")
+        header_size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(header_size))
+    base = _aligned(len(MAGIC) + 8 + header_size)
+    if header['version'] != VERSION:
+        raise ValueError(f"{filename}: unsupported version {header['version']}")
+
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        offset = base + entry['offset']
+        arrays[name] = data[offset:offset + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+
+    circuit = {'node_names': NodeNames(arrays.pop('node_names'), arrays.pop('node_starts'))}
+    if 'delays' in arrays:
+        csr = tuple(arrays.pop(name) for name in _GRAPH_ARRAYS[4:])
+        circuit['G'] = RetimingGraph(circuit['node_names'], *(arrays.pop(name) for name in _GRAPH_ARRAYS[:4]),
+                                     csr=csr)
+    circuit.update(arrays)
+    return circuit
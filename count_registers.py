@@ -5,13 +5,16 @@ from tqdm import tqdm
 from tqdm.contrib.concurrent import process_map
 import algorithm
 import graph_utils
+import wd_cache
 
 n_graphs = 1000
 n_nodes = 25
 k_out = 15
 max_delay = 10000
+# Set to wd_cache.WDCache(directory) to compute W and D of the corpus once and then read them from the cache
+cache = None
 count_file = open("count_registers.csv", 'w+')
-count_file.write("filename, nodes, edges, opt_1 registers, opt_2 registers\n")
+count_file.write("filename, nodes, edges, opt_1 registers, opt_2 registers, min area registers\n")
 count_file.flush()
 if not os.path.exists("dot"):
     os.mkdir("dot")
@@ -50,24 +53,26 @@ def gen_graph(random_seed):
 
     graph_utils.save_graph(graph_1, f"dot/run_{random_seed+1000}")
 
-def count_registers(G):
-    return sum([G.get_edge_data(*edge)['w'] for edge in G.edges])
-
 def calc_graph(random_seed):
     path = f"dot/run_{random_seed+1000}"
-    G = nx.nx_agraph.read_dot(path)
+    G = graph_utils.load_graph(path)
     G = graph_utils.preprocess(G)
-    W, D = algorithm.WD(G)
-    Gr = algorithm.OPT_1(G, W, D)
-    count_1 = count_registers(Gr)
-    clock_1 = max(algorithm.CP(Gr).values())
-    Gr = algorithm.OPT_2(G, D)
-    count_2 = count_registers(Gr)
-    clock_2 = max(algorithm.CP(Gr).values())
+    W, D = algorithm.WD(G, cache=cache)
+    Gr = algorithm.OPT_1(G, W, D, cache=cache)
+    count_1 = graph_utils.count_registers(Gr)
+    clock_1 = graph_utils.graph_stats(Gr)[2]
+    Gr = algorithm.OPT_2(G, D, cache=cache)
+    count_2 = graph_utils.count_registers(Gr)
+    clock_2 = graph_utils.graph_stats(Gr)[2]
+    # Minimum number of registers at the minimum clock
+    Gr = algorithm.MIN_AREA(G, W, D, c=clock_1)
+    count_3 = graph_utils.count_registers(Gr)
     nodes, edges, clock = graph_utils.graph_stats(Gr)
     # assert clock_1 == clock_2, f"{clock_1}, {clock_2}, {random_seed}"
-    count_file.write(f"{path}, {nodes}, {edges}, {count_1}, {count_2}\n")
-    count_file.flush()
+    return f"{path}, {nodes}, {edges}, {count_1}, {count_2}, {count_3}\n"
 
 # process_map(gen_graph, list(range(n_graphs)), max_workers=8)
-process_map(calc_graph, list(range(n_graphs)), max_workers=8)
\ No newline at end of file
+# The workers return their line, only this process writes the file (see batch.py for a streaming driver)
+for line in process_map(calc_graph, list(range(n_graphs)), max_workers=8):
+    count_file.write(line)
+count_file.flush()
\ No newline at end of file
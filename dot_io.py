@@ -0,0 +1,121 @@
+import re
+
+import numpy as np
+
+from retiming_graph import RetimingGraph
+
+# The DOT subset written by this project: one statement per line (its attribute list may span
+# several lines), nodes with a 'd' attribute and edges with a 'w' attribute (the other attributes
+# are ignored), names plain or double quoted
+_ID = r'"(?:[^"\\]|\\.)*"|-?[0-9.]+|[^\s\[\];,={}"<>-]+'
+_EDGE = re.compile(rf'\s*({_ID})\s*->\s*({_ID})\s*(?:\[([^\]]*)\])?\s*;?\s*$')
+_NODE = re.compile(rf'\s*({_ID})\s*(?:\[([^\]]*)\])?\s*;?\s*$')
+_ATTR = re.compile(rf'({_ID})\s*=\s*({_ID})')
+_DEFAULTS = re.compile(r'\s*(graph|node|edge)\s*\[([^\]]*)\]\s*;?\s*$', re.IGNORECASE)
+_HEADER = re.compile(r'\s*(strict\s+)?digraph\b[^{]*\{\s*$', re.IGNORECASE)
+_PLAIN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?)')
+# The DOT keywords (in any case) are names only when quoted
+_KEYWORDS = {'node', 'edge', 'graph', 'digraph', 'subgraph', 'strict'}
+
+
+def _unquote(name):
+    if name.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', name[1:-1])
+    return name
+
+
+def _quote(name):
+    name = str(name)
+    if _PLAIN.fullmatch(name) and name.lower() not in _KEYWORDS:
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _attributes(text):
+    return {key: _unquote(value) for key, value in _ATTR.findall(text or '')}
+
+
+def read_dot(filename):
+    # Parse the file line by line straight into a RetimingGraph, without building any graph object
+    node_index = {}
+    delays = []
+    edge_index = {}
+    src, dst, w = [], [], []
+    node_defaults, edge_defaults = {}, {}
+
+    def node(name):
+        u = node_index.get(name)
+        if u is None:
+            u = node_index[name] = len(delays)
+            delays.append(node_defaults.get('d'))
+        return u
+
+    with open(filename) as f:
+        line = ''
+        for line_number, text in enumerate(f, 1):
+            # An attribute list may continue on the next lines (as written by graphviz)
+            line = f"{line} {text.strip()}" if line else text.strip()
+            if line.count('[') > line.count(']'):
+                continue
+            line, statement = '', line
+            if not statement or statement == '}' or statement.startswith(('//', '#')) or _HEADER.match(statement):
+                continue
+
+            match = _EDGE.match(statement)
+            if match:
+                u, v = node(_unquote(match.group(1))), node(_unquote(match.group(2)))
+                weight = _attributes(match.group(3)).get('w', edge_defaults.get('w'))
+                if weight is None:
+                    raise ValueError(f"{filename}:{line_number}: edge without the 'w' attribute")
+                # strict digraph: a repeated edge updates the previous one
+                e = edge_index.setdefault((u, v), len(w))
+                if e == len(w):
+                    src.append(u)
+                    dst.append(v)
+                    w.append(int(weight))
+                else:
+                    w[e] = int(weight)
+                continue
+
+            match = _DEFAULTS.match(statement)
+            if match:
+                if match.group(1).lower() == 'node':
+                    node_defaults.update(_attributes(match.group(2)))
+                elif match.group(1).lower() == 'edge':
+                    edge_defaults.update(_attributes(match.group(2)))
+                continue
+
+            match = _NODE.match(statement)
+            if match:
+                u = node(_unquote(match.group(1)))
+                delay = _attributes(match.group(2)).get('d')
+                if delay is not None:
+                    delays[u] = delay
+                continue
+
+            raise ValueError(f"{filename}:{line_number}: unsupported DOT statement {statement!r}")
+
+    missing = [name for name, u in node_index.items() if delays[u] is None]
+    if missing:
+        raise ValueError(f"{filename}: nodes without the 'd' attribute: {missing[:10]}")
+
+    return RetimingGraph(list(node_index),
+                         np.array([int(d) for d in delays], dtype=np.int64),
+                         np.array(src, dtype=np.int64),
+                         np.array(dst, dtype=np.int64),
+                         np.array(w, dtype=np.int64))
+
+
+def write_dot(G, filename):
+    # Stream the nodes and the edges to the file, in the same format read by read_dot
+    with open(filename, 'w') as f:
+        f.write('strict digraph "" {\n')
+        if isinstance(G, RetimingGraph):
+            names = [_quote(name) for name in G.node_names]
+            f.writelines(f"\t{name}\t[d={d}];\n" for name, d in zip(names, G.delays.tolist()))
+            f.writelines(f"\t{names[u]} -> {names[v]}\t[w={w}];\n"
+                         for u, v, w in zip(G.edge_src.tolist(), G.edge_dst.tolist(), G.edge_w.tolist()))
+        else:
+            f.writelines(f"\t{_quote(name)}\t[d={d}];\n" for name, d in G.nodes(data='d'))
+            f.writelines(f"\t{_quote(u)} -> {_quote(v)}\t[w={w}];\n" for u, v, w in G.edges(data='w'))
+        f.write('}\n')
@@ -0,0 +1,290 @@
+import argparse
+import collections.abc
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import graph_utils
+from retiming_graph import RetimingGraph
+
+# Seeded generators built with array operations straight into a RetimingGraph: no networkx graph
+# is created, so circuits with millions of nodes fit in a few hundred MB. The families of
+# gen_circuits.py have the same nodes, edges and registers (the random delays come from numpy).
+
+
+class IndexNames(collections.abc.Sequence):
+    # Names prefix0, prefix1, ... of the first n nodes, then the host node: the strings are
+    # built only when they are used (e.g. while the circuit is written)
+
+    def __init__(self, n, prefix='', host='vh'):
+        self.n = n
+        self.prefix = prefix
+        self.host = host
+
+    def __len__(self):
+        return self.n + 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i <= self.n:
+            raise IndexError(i)
+        return self.host if i == self.n else f"{self.prefix}{i}"
+
+    def __iter__(self):
+        yield from (f"{self.prefix}{i}" for i in range(self.n))
+        yield self.host
+
+
+def _delays(rng, n, delay, random_delays):
+    return rng.integers(1, delay + 1, n) if random_delays else np.full(n, delay, dtype=np.int64)
+
+
+def _graph(names, delays, src, dst, w):
+    return RetimingGraph(names, delays, np.asarray(src), np.asarray(dst), np.asarray(w))
+
+
+def correlator(n_bit: int, host_delay: int = 0, compare_delay: int = 3, sum_delay: int = 7):
+    assert n_bit > 2, "n_bit should be at least 2"
+    # Nodes: the host, the comparators then the sum operators
+    names = ['vh'] + [f"vcomp_{i}" for i in range(n_bit)] + [f"vsum_{i}" for i in range(n_bit - 1)]
+    delays = np.array([host_delay] + [compare_delay] * n_bit + [sum_delay] * (n_bit - 1), dtype=np.int64)
+    comp = np.arange(1, n_bit + 1)
+    sums = np.arange(n_bit + 1, 2 * n_bit)
+
+    src = np.concatenate([[0], comp[:-1], [comp[-1], sums[-1]], sums[:-1], comp[:-1]])
+    dst = np.concatenate([[comp[0]], comp[1:], [sums[0], 0], sums[1:], sums[::-1]])
+    w = np.concatenate([np.ones(n_bit, dtype=np.int64), np.zeros(src.size - n_bit, dtype=np.int64)])
+    return _graph(names, delays, src, dst, w)
+
+
+def tree(depth: int, delay: int = 5, n_branch: int = 2, random_delays: bool = False, seed=None):
+    assert depth > 0, "depth should be at least 0"
+    rng = np.random.default_rng(seed)
+    # Nodes of the balanced tree in breadth first order, the parent of node i is (i - 1) // n_branch
+    n = depth + 1 if n_branch == 1 else (n_branch ** (depth + 1) - 1) // (n_branch - 1)
+    children = np.arange(1, n)
+    leaves = np.arange((n - 2) // n_branch + 1, n)
+
+    # Every child drives its parent, the root drives the host through depth + 1 registers and
+    # the host drives every leaf
+    src = np.concatenate([children, [0], np.full(leaves.size, n)])
+    dst = np.concatenate([(children - 1) // n_branch, [n], leaves])
+    w = np.zeros(src.size, dtype=np.int64)
+    w[n - 1] = depth + 1
+    delays = np.append(_delays(rng, n, delay, random_delays), 0)
+    return _graph(IndexNames(n), delays, src, dst, w)
+
+
+def full_graph(nodes: int, delay: int = 5, random_delays: bool = False, seed=None):
+    assert nodes > 0, "depth should be at least 0"
+    rng = np.random.default_rng(seed)
+    # Every node drives all the nodes with a smaller index, node 0 drives the host through nodes
+    # registers and the host drives the last node
+    src, dst = np.tril_indices(nodes, -1)
+    src = np.concatenate([src, [0, nodes]])
+    dst = np.concatenate([dst, [nodes, nodes - 1]])
+    w = np.zeros(src.size, dtype=np.int64)
+    w[-2] = nodes
+    delays = np.append(_delays(rng, nodes, delay, random_delays), 0)
+    return _graph(IndexNames(nodes), delays, src, dst, w)
+
+
+def _local_sources(rng, dst, locality):
+    # A source before each destination, at a geometric distance of mean locality (uniform if
+    # the distance goes past the first node)
+    src = dst - rng.geometric(1 / max(locality, 1), dst.size)
+    far = src < 0
+    src[far] = rng.integers(0, dst[far])
+    return src
+
+
+def random_netlist(nodes: int, fan_in: float = 2.5, locality: float = 64, register_prob: float = 0.1,
+                   feedback: float = 0.05, max_registers: int = 3, max_delay: int = 100, seed=None):
+    # Sparse netlist in the style of a synthesized circuit: the nodes are in topological order,
+    # each one reads 1 + Poisson(fan_in - 1) nearby earlier nodes, a forward edge holds a register
+    # with probability register_prob, and feedback * nodes backward edges hold 1 to max_registers
+    # registers. The host drives the inputs and reads the outputs through a register, so every
+    # cycle holds at least one register.
+    assert nodes > 1, "nodes should be at least 2"
+    rng = np.random.default_rng(seed)
+
+    counts = 1 + rng.poisson(max(fan_in - 1, 0), nodes)
+    counts[0] = 0
+    forward_dst = np.repeat(np.arange(nodes), counts)
+    forward_src = _local_sources(rng, forward_dst, locality)
+    forward_w = (rng.random(forward_dst.size) < register_prob).astype(np.int64)
+
+    back_src = rng.integers(1, nodes, int(feedback * nodes))
+    back_dst = _local_sources(rng, back_src, locality)
+    back_w = rng.integers(1, max_registers + 1, back_src.size)
+
+    src = np.concatenate([forward_src, back_src])
+    dst = np.concatenate([forward_dst, back_dst])
+    w = np.concatenate([forward_w, back_w])
+    # Repeated edges are merged (the first one is kept), as in a strict digraph
+    _, first = np.unique(src * nodes + dst, return_index=True)
+    first.sort()
+    src, dst, w = src[first], dst[first], w[first]
+
+    # Inputs: nodes without a forward fan in; outputs: nodes without a forward fan out
+    forward = src < dst
+    inputs = np.flatnonzero(np.bincount(dst[forward], minlength=nodes) == 0)
+    outputs = np.flatnonzero(np.bincount(src[forward], minlength=nodes) == 0)
+    src = np.concatenate([src, np.full(inputs.size, nodes), outputs])
+    dst = np.concatenate([dst, inputs, np.full(outputs.size, nodes)])
+    w = np.concatenate([w, np.zeros(inputs.size, dtype=np.int64), np.ones(outputs.size, dtype=np.int64)])
+
+    delays = np.append(rng.integers(1, max_delay + 1, nodes), 0)
+    return _graph(IndexNames(nodes, prefix='v'), delays, src, dst, w)
+
+
+def random_k_out(nodes: int, k_out: int = 15, zero_prob: float = 1 / 6, max_delay: int = 10000, seed=None):
+    # Array version of count_registers.gen_graph: k_out random successors per node, an edge
+    # without registers with probability zero_prob. The zero edges follow a random order of the
+    # nodes, so they are acyclic without searching and breaking cycles, and a ring of
+    # single register edges makes every node reachable from every other one (instead of adding
+    # an edge to each node that is not a descendant, which makes the graph complete).
+    assert nodes > 1, "nodes should be at least 2"
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(nodes)
+
+    src = np.repeat(np.arange(nodes), k_out)
+    dst = rng.integers(0, nodes - 1, src.size)
+    dst += dst >= src
+    zero = (rng.random(src.size) < zero_prob) & (order[src] < order[dst])
+    w = np.where(zero, 0, 1)
+
+    src = np.concatenate([src, order])
+    dst = np.concatenate([dst, np.roll(order, -1)])
+    w = np.concatenate([w, np.ones(nodes, dtype=np.int64)])
+    _, first = np.unique(src * nodes + dst, return_index=True)
+    first.sort()
+
+    names = [str(i) for i in range(nodes)]
+    return _graph(names, rng.integers(1, max_delay + 1, nodes), src[first], dst[first], w[first])
+
+
+FAMILIES = {
+    'correlator': (correlator, 'n_bit'),
+    'tree': (tree, 'depth'),
+    'full_graph': (full_graph, 'nodes'),
+    'random': (random_netlist, 'nodes'),
+    'k_out': (random_k_out, 'nodes'),
+}
+
+
+def generate(family, size, seed=None, **params):
+    # Circuit of the family, size is its main parameter (the number of nodes, bits or levels)
+    generator, size_name = FAMILIES[family]
+    params[size_name] = size
+    if family != 'correlator':
+        params['seed'] = seed
+    return generator(**params)
+
+
+def _generate_file(job):
+    family, size, seed, params, filename = job
+    start = time.time()
+    G = generate(family, size, seed, **params)
+    # The writers stream the nodes and the edges, the file is never built in memory
+    graph_utils.save_graph(G, filename)
+    return filename, G.n_nodes, G.n_edges, time.time() - start
+
+
+def gen_corpus(directory, family, sizes, count=1, extension='.dot', jobs=1, seed=0, **params):
+    # count circuits of each size, generated by jobs processes. The seed of a circuit depends only
+    # on seed and on its position, so the corpus is the same whatever the number of jobs.
+    os.makedirs(directory, exist_ok=True)
+    job_list = []
+    for size in sizes:
+        for i in range(count):
+            filename = os.path.join(directory, f"{family}_{size}_{i}{extension}")
+            job_list.append((family, size, [seed, size, i], params, filename))
+    if jobs == 1:
+        return [_generate_file(job) for job in job_list]
+    with multiprocessing.Pool(jobs) as pool:
+        return list(pool.imap_unordered(_generate_file, job_list))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a corpus of circuits')
+
+    parser.add_argument('--family',
+                        action='store',
+                        type=str,
+                        choices=list(FAMILIES),
+                        help='circuit family',
+                        default='random')
+
+    parser.add_argument('--sizes',
+                        action='store',
+                        type=str,
+                        help='comma separated sizes: nodes, bits of the correlator or depth of the tree',
+                        default='100000')
+
+    parser.add_argument('--count',
+                        action='store',
+                        type=int,
+                        help='number of circuits of each size',
+                        default=1)
+
+    parser.add_argument('--output-dir',
+                        action='store',
+                        type=str,
+                        help='directory of the generated circuits',
+                        default='dot')
+
+    parser.add_argument('--format',
+                        action='store',
+                        type=str,
+                        choices=['dot', 'rtg'],
+                        help='format of the circuit files',
+                        default='dot')
+
+    parser.add_argument('--jobs',
+                        action='store',
+                        type=int,
+                        help='number of processes generating the circuits',
+                        default=os.cpu_count())
+
+    parser.add_argument('--seed',
+                        action='store',
+                        type=int,
+                        help='seed of the corpus',
+                        default=0)
+
+    parser.add_argument('--fan-in',
+                        action='store',
+                        type=float,
+                        help='mean fan in of the nodes of the random netlists',
+                        default=2.5)
+
+    parser.add_argument('--register-prob',
+                        action='store',
+                        type=float,
+                        help='probability of a register on a forward edge of the random netlists',
+                        default=0.1)
+
+    parser.add_argument('--feedback',
+                        action='store',
+                        type=float,
+                        help='feedback edges per node of the random netlists',
+                        default=0.05)
+
+    args = parser.parse_args()
+    params = {}
+    if args.family == 'random':
+        params = {'fan_in': args.fan_in, 'register_prob': args.register_prob, 'feedback': args.feedback}
+
+    start = time.time()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    files = gen_corpus(args.output_dir, args.family, sizes, args.count, '.' + args.format, args.jobs, args.seed,
+                       **params)
+    for filename, n_nodes, n_edges, elapsed in sorted(files):
+        print(f"{filename}: {n_nodes} nodes, {n_edges} edges in {elapsed:.2f} s")
+    print(f"{len(files)} circuits generated in {time.time() - start:.2f} s")
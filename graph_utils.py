@@ -1,16 +1,20 @@
-import copy
-
 import networkx as nx
 import numpy as np
-import matplotlib.pyplot as plt
 
 import algorithm
+import circuit_io
+import dot_io
+from retiming_graph import RetimingGraph
+
 
+def preprocess(G):
 
-def preprocess(G: nx.DiGraph):
+    # The array representation is already typed
+    if isinstance(G, RetimingGraph):
+        return G
 
-    # Clone graph G
-    G = copy.deepcopy(G)
+    # Clone graph G, the attribute dictionaries are copied, so G is not modified
+    G = G.copy()
 
     # Preprocess the data
     for edge_key, edge_property in G.edges.items():
@@ -23,13 +27,16 @@ def preprocess(G: nx.DiGraph):
 
     return G
 
-def retime_graph(G: nx.DiGraph, r):
+def retime_graph(G, r):
+
+    if isinstance(G, RetimingGraph):
+        return G.retime(r)
 
-    # Clone the graph
-    Gr = copy.deepcopy(G)
+    # Clone the graph, the attribute dictionaries are copied, so G is not modified
+    Gr = G.copy()
     # Move the registers
-    for u, v in list(G.edges):
-        Gr[u][v]['w'] = G[u][v]['w'] + r[v] - r[u]
+    for u, v, w in G.edges(data='w'):
+        Gr[u][v]['w'] = w + r[v] - r[u]
 
     # Return the new graph
     return Gr
@@ -41,16 +48,36 @@ def print_graph(G: nx.DiGraph):
 
 
 def draw_graph(G: nx.DiGraph):
+    # matplotlib is slow to import and only needed here
+    import matplotlib.pyplot as plt
     nx.draw(G, pos=nx.circular_layout(G), with_labels=True)
     nx.draw_networkx_edge_labels(G, pos=nx.circular_layout(G))
     plt.show()
 
 
+def load_graph(filename):
+    # The binary circuit format is chosen by the extension of the file, DOT otherwise
+    if filename.endswith(circuit_io.EXTENSION):
+        return circuit_io.read_circuit(filename)['G']
+    return dot_io.read_dot(filename)
+
+
 def save_graph(G, filename="example.dot"):
-    nx.nx_agraph.write_dot(G, filename)
+    # The binary circuit format is chosen by the extension of the file, DOT otherwise
+    if filename.endswith(circuit_io.EXTENSION):
+        circuit_io.write_circuit(filename, G if isinstance(G, RetimingGraph) else RetimingGraph.from_networkx(G))
+    else:
+        dot_io.write_dot(G, filename)
 
 def graph_stats(G):
+    if isinstance(G, RetimingGraph):
+        return G.n_nodes, G.n_edges, int(algorithm.CP(G).max())
     n_nodes = len(G.nodes)
     n_edges = len(G.edges)
     f_clock = max(algorithm.CP(G).values())
-    return n_nodes, n_edges, f_clock
\ No newline at end of file
+    return n_nodes, n_edges, f_clock
+
+def count_registers(G):
+    if isinstance(G, RetimingGraph):
+        return int(G.edge_w.sum())
+    return sum(int(w) for _, _, w in G.edges(data='w'))
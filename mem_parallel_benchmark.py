@@ -10,26 +10,34 @@ from tqdm.contrib.concurrent import process_map
 import algorithm
 import graph_utils
 import gen_circuits
+import wd_cache
 
 file = open("mem_result.csv", "w+")
 
 n_runs = 20
+# W and D are measured in every run, set to wd_cache.WDCache(directory) to compute them in the first run only
+cache = None
 
 def dispatcher(args):
     return single_run(args[0], args[1])
 
 def opt_1(G):
     time_1 = time.time()
-    W, D = algorithm.WD(G)
-    Gr_1 = algorithm.OPT_1(G, W, D)
+    W, D = algorithm.WD(G, cache=cache)
+    Gr_1 = algorithm.OPT_1(G, W, D, cache=cache)
     return time.time() - time_1
 
 def opt_2(G):
     time_2 = time.time()
-    W, D = algorithm.WD(G)
-    Gr_2 = algorithm.OPT_2(G, D)
+    W, D = algorithm.WD(G, cache=cache)
+    Gr_2 = algorithm.OPT_2(G, D, cache=cache)
     return time.time() - time_2
 
+def opt_3(G):
+    time_3 = time.time()
+    W, D = algorithm.WD(G, cache=cache)
+    Gr_3 = algorithm.OPT_3(G, W, D)
+    return time.time() - time_3
 
 def single_run(G, run_name):
     # Using OPT 1
@@ -42,11 +50,15 @@ def single_run(G, run_name):
     mem_2 = memory_profiler.memory_usage((opt_2, (G,) ), interval=.01)
     max_mem_2 = max(mem_2)
     inc_mem_2 = max_mem_2 - min(mem_2)
+    # Using OPT 3
+    mem_3 = memory_profiler.memory_usage((opt_3, (G,) ), interval=.01)
+    max_mem_3 = max(mem_3)
+    inc_mem_3 = max_mem_3 - min(mem_3)
 
     # Check
     nodes, edges, clock = graph_utils.graph_stats(G)
 
-    file.write(f"{run_name}, {nodes}, {edges}, {max_mem_1}, {inc_mem_1}, {max_mem_2}, {inc_mem_2}\n")
+    file.write(f"{run_name}, {nodes}, {edges}, {max_mem_1}, {inc_mem_1}, {max_mem_2}, {inc_mem_2}, {max_mem_3}, {inc_mem_3}\n")
     file.flush()
 
 runs = []
@@ -1,14 +1,20 @@
 import argparse
-import networkx as nx
+import os
+import numpy as np
 import algorithm
+import circuit_io
+import dot_io
 import graph_utils
+import tracing
+import wd_cache
+from retiming_graph import retiming_vector
 
 parser = argparse.ArgumentParser(description='OPT 1 and OPT 2 library')
 
 parser.add_argument('--input',
                     action='store',
                     type=str,
-                    help='input dot file',
+                    help='input dot file, or binary circuit file (.rtg) with W and D if they are saved in it',
                     default='example.dot')
 
 parser.add_argument('--verbose',
@@ -20,18 +26,121 @@ parser.add_argument('--verbose',
 parser.add_argument('--output',
                     action='store',
                     type=str,
-                    help='output dot file',
+                    help='output dot file, or binary circuit file (.rtg)',
                     default='output.dot')
 
+parser.add_argument('--wd-method',
+                    action='store',
+                    type=str,
+                    choices=['auto', 'dense', 'sparse', 'blocked', 'tiled'],
+                    help='engine used to compute W and D',
+                    default='auto')
+
+parser.add_argument('--jobs',
+                    action='store',
+                    type=int,
+                    help='number of processes of the sparse W and D engine, or threads of the blocked and tiled ones',
+                    default=1)
+
+parser.add_argument('--wd-dir',
+                    action='store',
+                    type=str,
+                    help='directory of the memory mapped W and D files (tiled engine)',
+                    default=None)
+
+parser.add_argument('--tile-budget',
+                    action='store',
+                    type=int,
+                    help='memory budget (MB) of the blocks of W and D held in memory',
+                    default=256)
+
+parser.add_argument('--search-jobs',
+                    action='store',
+                    type=int,
+                    help='number of clocks probed at the same time by the search',
+                    default=1)
+
+parser.add_argument('--cache-dir',
+                    action='store',
+                    type=str,
+                    help='directory of the W and D cache, if set W and D of a known circuit are not computed again',
+                    default=None)
+
+parser.add_argument('--cache-size',
+                    action='store',
+                    type=int,
+                    help='size limit (MB) of the W and D cache',
+                    default=1024)
+
+parser.add_argument('--min-area',
+                    action='store',
+                    type=bool,
+                    help='if enable, the registers are minimized at the optimized clock',
+                    default=False)
+
+parser.add_argument('--retiming-only',
+                    action='store',
+                    type=bool,
+                    help='if enable, only the retiming vector r is saved in the output (binary circuit file)',
+                    default=False)
+
+parser.add_argument('--save-wd',
+                    action='store',
+                    type=str,
+                    help='binary circuit file (.rtg) where the input graph, W and D are saved for the next runs',
+                    default=None)
+
+parser.add_argument('--lean',
+                    action='store',
+                    type=bool,
+                    help='if enable, OPT 1 runs without W and D (memory O(V + E + constraints) instead of O(V^2))',
+                    default=False)
+
+parser.add_argument('--trace',
+                    action='store',
+                    type=str,
+                    help='if set, a Chrome trace (JSON) of W and D and of the search is saved in this file',
+                    default=None)
+
+parser.add_argument('--budget',
+                    action='store',
+                    type=float,
+                    help='time budget (seconds) of the search, the best retiming found within it is saved',
+                    default=None)
+
+parser.add_argument('--state',
+                    action='store',
+                    type=str,
+                    help='file of the search state: the search resumes from it if it exists, and it is saved at the end',
+                    default=None)
+
 args = parser.parse_args()
 input_file = args.input
 verbose = args.verbose
 output_file = args.output
+wd_method = args.wd_method
+n_jobs = args.jobs
+wd_dir = args.wd_dir
+tile_budget = args.tile_budget * 2 ** 20
+search_jobs = args.search_jobs
+min_area = args.min_area
+retiming_only = args.retiming_only
+save_wd = args.save_wd
+lean = args.lean
+budget = args.budget
+state_file = args.state
+tracer = None if args.trace is None else tracing.Tracer()
+cache = None if args.cache_dir is None else wd_cache.WDCache(args.cache_dir, args.cache_size * 2 ** 20)
 
 if verbose:
     print("Reading input graph...")
 
-G = nx.nx_agraph.read_dot(input_file)
+# The binary circuit files are memory mapped, and they may already hold W and D
+if input_file.endswith(circuit_io.EXTENSION):
+    circuit = circuit_io.read_circuit(input_file)
+    G, W, D = circuit['G'], circuit.get('W'), circuit.get('D')
+else:
+    G, W, D = dot_io.read_dot(input_file), None, None
 if verbose:
     nodes, edges, clock = graph_utils.graph_stats(G)
     print(f"The input graph has {nodes} nodes, {edges} edges.")
@@ -41,24 +150,56 @@ if verbose:
     print("Starting graph preprocessing...")
 
 G = graph_utils.preprocess(G)
-if verbose:
-    print("Computing matrix W and D...")
+# The lean OPT 1 needs W and D only to save them or to minimize the registers
+if (W is None or D is None) and (not lean or save_wd is not None or min_area):
+    if verbose:
+        print("Computing matrix W and D...")
+    W, D = algorithm.WD(G, method=wd_method, n_jobs=n_jobs, directory=wd_dir, tile_budget=tile_budget, cache=cache,
+                        tracer=tracer)
 
-W, D = algorithm.WD(G)
+if save_wd is not None:
+    circuit_io.write_circuit(save_wd, G, W, D)
 if verbose:
     print("D is:")
     # print(f"{D}")
     print("W is:")
     # print(f"{W}")
 
+# The search state of a previous run, stopped by its budget, is resumed
+state = None
+if state_file is not None:
+    state = algorithm.SearchState.load(state_file) if os.path.exists(state_file) else algorithm.SearchState()
 if verbose:
     print("Running OPT 1...")
-Gr = algorithm.OPT_1(G, W, D)
-nodes, edges, clock = graph_utils.graph_stats(G)
+if lean:
+    Gr = algorithm.OPT_1_LEAN(G, verbose=verbose, budget=budget, state=state, tracer=tracer)
+else:
+    # W and D out of core (tiled engine or binary circuit file): the constraints are read again at each probe
+    Gr = algorithm.OPT_1(G, W, D, tile_budget=tile_budget, incremental=not isinstance(D, np.memmap), n_jobs=search_jobs,
+                         cache=cache, budget=budget, state=state, tracer=tracer)
+nodes, edges, clock = graph_utils.graph_stats(Gr)
 if verbose:
     print(f"OPT 1 COMPLETED.")
     print(f"The OPT 1 optimized graph has {nodes} nodes, {edges} edges.")
 print(f"The clock of the OPT 1 optimized graph is {clock} cycles.")
+if state is not None:
+    if not state.done:
+        print(f"The search is not over: the minimum clock is at least {state.lower} cycles.")
+    state.save(state_file)
+
+if min_area:
+    if verbose:
+        print("Minimizing the registers...")
+    Gr = algorithm.MIN_AREA(G, W, D, c=clock, verbose=verbose, tile_budget=tile_budget)
+    print(f"The min area retimed graph has {graph_utils.count_registers(Gr)} registers.")
+
+if retiming_only:
+    circuit_io.write_circuit(output_file, r=retiming_vector(G, Gr), node_names=G.node_names)
+    print(f"The retiming vector has been saved.")
+else:
+    graph_utils.save_graph(Gr, output_file)
+    print(f"The retimed graph has been saved.")
 
-graph_utils.save_graph(Gr, output_file)
-print(f"The retimed graph has been saved.")
\ No newline at end of file
+if tracer is not None:
+    tracer.save(args.trace)
+    print(f"The trace has been saved.")
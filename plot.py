@@ -2,7 +2,7 @@ import plotly.express as px
 import pandas as pd
 
 df = pd.read_csv("cpu_result.csv", header=None)
-df.columns = ["name", "V", "E", "time_opt_1", "std_1", "time_opt_2", "std_2"]
+df.columns = ["name", "V", "E", "time_opt_1", "std_1", "time_opt_2", "std_2", "time_opt_3", "std_3"]
 fig = px.scatter(df[df["name"].map(lambda x: "random_delays" in x)],
                  x="V",
                  y="E",
@@ -32,4 +32,16 @@ fig = px.scatter(df[df["name"].map(lambda x: "random_delays" not in x and "Corre
                  hover_name="name",
                  size_max=50)
 fig.show()
-fig.write_html("time_bench.html")
\ No newline at end of file
+fig.write_html("time_bench.html")
+
+# OPT 3 against OPT 1: the size of the bubble is the time of OPT 1 and the color the time of OPT 3
+fig = px.scatter(df,
+                 x="V",
+                 y="E",
+                 color="time_opt_3",
+                 size="time_opt_1",
+                 log_x=True,
+                 hover_name="name",
+                 size_max=50)
+fig.show()
+fig.write_html("time_bench_opt_3.html")
\ No newline at end of file
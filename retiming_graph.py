@@ -0,0 +1,203 @@
+import collections.abc
+
+import networkx as nx
+import numpy as np
+
+
+class RetimingGraph:
+    # Compact circuit representation: node delays, edge endpoints and register
+    # counts are stored in contiguous int64 arrays. The outgoing (CSR) and the
+    # incoming (reverse CSR) adjacency are built once and shared by the retimed copies.
+
+    def __init__(self, node_names, delays, edge_src, edge_dst, edge_w, csr=None):
+        # Any sequence is kept as it is (e.g. the lazily decoded names of a circuit file)
+        self.node_names = node_names if isinstance(node_names, collections.abc.Sequence) else list(node_names)
+        self.delays = np.ascontiguousarray(delays, dtype=np.int64)
+        self.edge_src = np.ascontiguousarray(edge_src, dtype=np.int64)
+        self.edge_dst = np.ascontiguousarray(edge_dst, dtype=np.int64)
+        self.edge_w = np.ascontiguousarray(edge_w, dtype=np.int64)
+        self._node_index = None
+
+        assert len(self.node_names) == self.delays.size, "one delay per node is required"
+        assert self.edge_src.size == self.edge_dst.size == self.edge_w.size, "edge arrays must have the same size"
+
+        # The adjacency can be given as (out_ptr, out_edges, in_ptr, in_edges), e.g. read from a file
+        if csr is not None:
+            self.out_ptr, self.out_edges, self.in_ptr, self.in_edges = csr
+            return
+
+        # Outgoing adjacency: out_edges[out_ptr[u]:out_ptr[u + 1]] are the edges leaving u
+        self.out_ptr, self.out_edges = self._build_csr(self.edge_src)
+        # Incoming adjacency: in_edges[in_ptr[v]:in_ptr[v + 1]] are the edges entering v
+        self.in_ptr, self.in_edges = self._build_csr(self.edge_dst)
+
+    def _build_csr(self, keys):
+        counts = np.bincount(keys, minlength=self.n_nodes)
+        ptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        edges = np.argsort(keys, kind='stable').astype(np.int64)
+        return ptr, edges
+
+    @property
+    def n_nodes(self):
+        return self.delays.size
+
+    @property
+    def n_edges(self):
+        return self.edge_w.size
+
+    @property
+    def edge_delays(self):
+        # Delay of the source of each edge (the 'd' edge attribute set by graph_utils.preprocess)
+        return self.delays[self.edge_src]
+
+    @property
+    def node_index(self):
+        if self._node_index is None:
+            self._node_index = dict(zip(self.node_names, range(self.n_nodes)))
+        return self._node_index
+
+    def out_edges_of(self, nodes):
+        # Edges leaving any of the given nodes
+        return self.out_edges[csr_positions(self.out_ptr, nodes)]
+
+    def in_edges_of(self, nodes):
+        # Edges entering any of the given nodes
+        return self.in_edges[csr_positions(self.in_ptr, nodes)]
+
+    def successors(self, u):
+        return self.edge_dst[self.out_edges[self.out_ptr[u]:self.out_ptr[u + 1]]]
+
+    def predecessors(self, v):
+        return self.edge_src[self.in_edges[self.in_ptr[v]:self.in_ptr[v + 1]]]
+
+    def retime(self, r):
+        # Build the retimed graph, the adjacency structure is shared with the current one
+        r = np.asarray(r, dtype=np.int64)
+        Gr = copy_structure(self)
+        Gr.edge_w = self.edge_w + r[self.edge_dst] - r[self.edge_src]
+        return Gr
+
+    @classmethod
+    def from_networkx(cls, G: nx.DiGraph):
+        node_names = list(G.nodes)
+        node_dict = dict(zip(node_names, range(len(node_names))))
+        delays = np.fromiter((int(G.nodes[node]['d']) for node in node_names), dtype=np.int64, count=len(node_names))
+        n_edges = G.number_of_edges()
+        edge_src = np.empty(n_edges, dtype=np.int64)
+        edge_dst = np.empty(n_edges, dtype=np.int64)
+        edge_w = np.empty(n_edges, dtype=np.int64)
+        for i, (u, v, w) in enumerate(G.edges(data='w')):
+            edge_src[i] = node_dict[u]
+            edge_dst[i] = node_dict[v]
+            edge_w[i] = int(w)
+        return cls(node_names, delays, edge_src, edge_dst, edge_w)
+
+    def to_networkx(self):
+        G = nx.DiGraph()
+        names = self.node_names
+        G.add_nodes_from((name, {'d': int(d)}) for name, d in zip(names, self.delays.tolist()))
+        G.add_edges_from((names[u], names[v], {'w': w, 'd': d})
+                         for u, v, w, d in zip(self.edge_src.tolist(),
+                                               self.edge_dst.tolist(),
+                                               self.edge_w.tolist(),
+                                               self.edge_delays.tolist()))
+        return G
+
+    def __repr__(self):
+        return f"RetimingGraph(nodes={self.n_nodes}, edges={self.n_edges})"
+
+
+def csr_positions(ptr, nodes):
+    # Positions ptr[u]:ptr[u + 1] of every node u, concatenated without a python loop
+    starts = ptr[nodes]
+    counts = ptr[nodes + 1] - starts
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if ends.size else 0)
+
+
+def zero_register_delta(G: RetimingGraph, edge_w):
+    # DELTA of every node with the registers edge_w: the delay of the longest path without
+    # registers ending in it. ValueError if the edges without registers have a cycle.
+    # Retrieve the edges where w is equal to zero
+    zero_edges = np.flatnonzero(edge_w == 0)
+    src = G.edge_src[zero_edges].tolist()
+    dst = G.edge_dst[zero_edges].tolist()
+
+    # DELTA (as described in the paper), the starting DELTA of each vertex is its delay
+    delays = G.delays.tolist()
+    delta = list(delays)
+
+    # Topological sort the zero weight subgraph (Kahn algorithm)
+    succ = [[] for _ in range(G.n_nodes)]
+    in_degree = [0] * G.n_nodes
+    for u, v in zip(src, dst):
+        succ[u].append(v)
+        in_degree[v] += 1
+    queue = [v for v in range(G.n_nodes) if in_degree[v] == 0]
+
+    # Compute DELTA incrementally following the topological order
+    for u in queue:
+        for v in succ[u]:
+            if delta[u] + delays[v] > delta[v]:
+                delta[v] = delta[u] + delays[v]
+            in_degree[v] -= 1
+            if in_degree[v] == 0:
+                queue.append(v)
+
+    if len(queue) != G.n_nodes:
+        raise ValueError("the graph contains a cycle without registers")
+
+    return np.array(delta, dtype=np.int64)
+
+
+def retiming_vector(G: RetimingGraph, Gr: RetimingGraph):
+    # Retiming r such that Gr is G retimed by r (w_r(e) = w(e) + r(v) - r(u)), r is 0 on the first
+    # node of each weakly connected component. None if Gr is not a retiming of G.
+    n = G.n_nodes
+    delta = Gr.edge_w - G.edge_w
+
+    # Edges in both directions grouped by end: going along e from u to v adds delta(e) to r,
+    # going back subtracts it
+    ends = np.concatenate([G.edge_src, G.edge_dst])
+    order = np.argsort(ends, kind='stable')
+    others = np.concatenate([G.edge_dst, G.edge_src])[order].tolist()
+    steps = np.concatenate([delta, -delta])[order].tolist()
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ends, minlength=n), out=ptr[1:])
+    ptr = ptr.tolist()
+
+    # One breadth first search per component, every node and edge is visited once
+    r = [None] * n
+    for root in range(n):
+        if r[root] is not None:
+            continue
+        r[root] = 0
+        queue = [root]
+        for u in queue:
+            r_u = r[u]
+            for i in range(ptr[u], ptr[u + 1]):
+                v = others[i]
+                if r[v] is None:
+                    r[v] = r_u + steps[i]
+                    queue.append(v)
+    r = np.array(r, dtype=np.int64)
+
+    # Every edge must agree with the potentials found along the search trees
+    if not np.array_equal(r[G.edge_dst] - r[G.edge_src], delta):
+        return None
+    return r
+
+
+def copy_structure(G: RetimingGraph):
+    # Shallow copy: the arrays are shared, so it is cheap even for large graphs
+    Gc = RetimingGraph.__new__(RetimingGraph)
+    Gc.__dict__.update(G.__dict__)
+    return Gc
+
+
+def as_retiming_graph(G):
+    # Return the array representation of G and whether G was a networkx graph
+    if isinstance(G, RetimingGraph):
+        return G, False
+    return RetimingGraph.from_networkx(G), True
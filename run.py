@@ -1,9 +1,10 @@
 import argparse
-import networkx as nx
 import algorithm
+import dot_io
 import gen_circuits
 import graph_utils
 import numpy as np
+import wd_cache
 parser = argparse.ArgumentParser(description='OPT 1 and OPT 2 library')
 
 parser.add_argument('--input',
@@ -18,14 +19,21 @@ parser.add_argument('--verbose',
                     help='if enable, it will be verbose',
                     default=True)
 
+parser.add_argument('--cache-dir',
+                    action='store',
+                    type=str,
+                    help='directory of the W and D cache, if set W and D of a known circuit are not computed again',
+                    default=None)
+
 args = parser.parse_args()
 input_file = args.input
 verbose = args.verbose
+cache = None if args.cache_dir is None else wd_cache.WDCache(args.cache_dir)
 
 if verbose:
     print("Reading input graph...")
 
-G = nx.nx_agraph.read_dot(input_file)
+G = dot_io.read_dot(input_file)
 # G = gen_circuits.gen_correlator(30)
 G = graph_utils.preprocess(G)
 if verbose:
@@ -37,7 +45,7 @@ if verbose:
 if verbose:
     print("Computing matrix W and D...")
 
-W, D = algorithm.WD(G)
+W, D = algorithm.WD(G, cache=cache)
 if verbose:
     print("D is:")
     print(f"{D}")
@@ -46,16 +54,23 @@ if verbose:
 
 if verbose:
     print("Running OPT 1...")
-Gr = algorithm.OPT_1(G, W, D, verbose=verbose)
+Gr = algorithm.OPT_1(G, W, D, verbose=verbose, cache=cache)
 nodes, edges, clock = graph_utils.graph_stats(Gr)
 if verbose:
     print(f"OPT 1 COMPLETED.")
     print(f"The OPT 1 optimized graph has {nodes} nodes, {edges} edges.")
 print(f"The clock of the OPT 1 optimized graph is {clock} cycles.")
 
-Gr = algorithm.OPT_2(G, D, verbose=verbose)
+Gr = algorithm.OPT_2(G, D, verbose=verbose, cache=cache)
 nodes, edges, clock = graph_utils.graph_stats(Gr)
 if verbose:
     print(f"OPT 2 COMPLETED.")
     print(f"The OPT 2 optimized graph has {nodes} nodes, {edges} edges.")
-print(f"The clock of the OPT 2 optimized graph is {clock} cycles.")
\ No newline at end of file
+print(f"The clock of the OPT 2 optimized graph is {clock} cycles.")
+
+Gr = algorithm.OPT_3(G, W, D, verbose=verbose)
+nodes, edges, clock = graph_utils.graph_stats(Gr)
+if verbose:
+    print(f"OPT 3 COMPLETED.")
+    print(f"The OPT 3 optimized graph has {nodes} nodes, {edges} edges.")
+print(f"The clock of the OPT 3 optimized graph is {clock} cycles.")
\ No newline at end of file
@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+import algorithm
+import graph_utils
+import wd_cache
+
+
+class CircuitState:
+    # Everything kept in memory for a loaded circuit: the graph, W and D, the sorted period
+    # constraints and the answers already computed
+
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self.G = graph_utils.preprocess(graph_utils.load_graph(path))
+        self.W, self.D = algorithm.WD(self.G, cache=cache)
+        self.candidates = algorithm.candidate_clocks(self.G, self.D, cache=cache)
+        self.constraints = algorithm.PeriodConstraints(self.G, self.W, self.D, int(self.candidates[0]))
+        self.clock = int(algorithm.CP(self.G).max())
+        self.retimings = {}
+        self.min_clock = None
+        self.lock = threading.Lock()
+
+    def retiming(self, c):
+        # Retiming of clock c (None if c is not feasible), the clocks below the smallest candidate
+        # are never feasible
+        c = int(c)
+        with self.lock:
+            if c not in self.retimings:
+                self.retimings[c] = None if c < self.constraints.lower else self.constraints.solve(c)
+            return self.retimings[c]
+
+    def minimum_clock(self):
+        with self.lock:
+            if self.min_clock is None:
+                best_r = algorithm._binary_search(
+                    self.candidates, lambda c, best_r: self.constraints.solve(c, initial=best_r))
+                r = np.zeros(self.G.n_nodes, dtype=np.int64) if best_r is None else best_r
+                self.min_clock = int(algorithm.CP(self.G.retime(r)).max())
+                self.retimings[self.min_clock] = r
+            return self.min_clock
+
+
+OPERATIONS = {'ping', 'load', 'min_period', 'feasible', 'retime', 'registers', 'unload'}
+
+
+def _resolve(directory, path):
+    # Path of a request, relative to directory: the absolute paths and '..' are refused, and so are
+    # the symbolic links that lead out of directory, a client only reaches the files under it
+    if os.path.isabs(path) or '..' in path.replace(os.sep, '/').split('/'):
+        raise ValueError(f"The path {path!r} must be relative and without '..'")
+    directory = os.path.realpath(directory)
+    resolved = os.path.realpath(os.path.join(directory, path))
+    if os.path.commonpath([resolved, directory]) != directory:
+        raise ValueError(f"The path {path!r} leads out of the server directory")
+    return resolved
+
+
+class RetimingServer:
+    # Requests and answers are JSON objects, one per line. Every request names a circuit file with
+    # 'path', relative to root: the circuit is loaded on its first request and reloaded only if the
+    # file changes. The retimed circuits are saved under output_dir, if set.
+
+    def __init__(self, cache=None, root='.', output_dir=None):
+        self.cache = cache
+        self.root = root
+        self.output_dir = output_dir
+        self.circuits = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def circuit(self, path):
+        # The global lock only guards the dictionaries: a circuit is loaded under its own lock, so
+        # the requests on the other circuits are not blocked by its W and D
+        path = _resolve(self.root, path)
+        with self.lock:
+            loading = self.loading.setdefault(path, threading.Lock())
+        with loading:
+            with self.lock:
+                state = self.circuits.get(path)
+            if state is None or state.mtime != os.path.getmtime(path):
+                state = CircuitState(path, self.cache)
+                with self.lock:
+                    self.circuits[path] = state
+            return state
+
+    def handle(self, request):
+        op = request.get('op')
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown operation {op}")
+        if op == 'ping':
+            return {}
+        if op == 'unload':
+            path = _resolve(self.root, request['path'])
+            with self.lock:
+                self.circuits.pop(path, None)
+            return {}
+
+        state = self.circuit(request['path'])
+        if op == 'load':
+            return {'nodes': state.G.n_nodes, 'edges': state.G.n_edges, 'clock': state.clock,
+                    'registers': graph_utils.count_registers(state.G)}
+        if op == 'min_period':
+            return {'clock': state.minimum_clock()}
+        if op == 'feasible':
+            return {'feasible': state.retiming(request['c']) is not None}
+        if op == 'retime':
+            r = state.retiming(request['c'])
+            if r is None:
+                raise ValueError(f"Clock {request['c']} is not feasible")
+            Gr = state.G.retime(r)
+            answer = {'clock': int(algorithm.CP(Gr).max()), 'registers': graph_utils.count_registers(Gr)}
+            # The retimed graph is saved if an output file is given, r is sent back otherwise
+            if 'output' in request:
+                if self.output_dir is None:
+                    raise ValueError("The server does not save the retimed circuits, it has no --output-dir")
+                graph_utils.save_graph(Gr, _resolve(self.output_dir, request['output']))
+            else:
+                answer['r'] = r.tolist()
+            return answer
+        if op == 'registers':
+            c = request.get('c', state.clock)
+            if request.get('min_area', False):
+                Gr = algorithm.MIN_AREA(state.G, state.W, state.D, c=int(c))
+            else:
+                r = state.retiming(c)
+                if r is None:
+                    raise ValueError(f"Clock {c} is not feasible")
+                Gr = state.G.retime(r)
+            return {'registers': graph_utils.count_registers(Gr)}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            start = time.perf_counter()
+            try:
+                answer = self.server.retiming.handle(json.loads(line))
+                answer['ok'] = True
+            except Exception as e:
+                answer = {'ok': False, 'error': repr(e)}
+            answer['time'] = time.perf_counter() - start
+            self.wfile.write(json.dumps(answer).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Client:
+    # Keeps one connection open, so a request costs a single round trip
+
+    def __init__(self, socket_path=None, port=None):
+        if socket_path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(socket_path)
+        else:
+            self.socket = socket.create_connection(('127.0.0.1', port))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, op, **arguments):
+        self.file.write(json.dumps(dict(arguments, op=op)).encode() + b'\n')
+        self.file.flush()
+        answer = json.loads(self.file.readline())
+        if not answer.pop('ok'):
+            raise RuntimeError(answer['error'])
+        return answer
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def serve(socket_path=None, port=None, cache=None, root='.', output_dir=None):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _Handler)
+    else:
+        server = _TCPServer(('127.0.0.1', port), _Handler)
+    server.retiming = RetimingServer(cache, root, output_dir)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Retiming server')
+
+    parser.add_argument('--socket',
+                        action='store',
+                        type=str,
+                        help='path of the Unix socket the server listens on',
+                        default='retiming.sock')
+
+    parser.add_argument('--port',
+                        action='store',
+                        type=int,
+                        help='if set, the server listens on this localhost TCP port instead of the Unix socket',
+                        default=None)
+
+    parser.add_argument('--cache-dir',
+                        action='store',
+                        type=str,
+                        help='directory of the W and D cache',
+                        default=None)
+
+    parser.add_argument('--root',
+                        action='store',
+                        type=str,
+                        help='directory of the circuit files, the paths of the requests are relative to it',
+                        default='.')
+
+    parser.add_argument('--output-dir',
+                        action='store',
+                        type=str,
+                        help='directory of the retimed circuits saved by the requests, if not set they are not saved',
+                        default=None)
+
+    args = parser.parse_args()
+    cache = None if args.cache_dir is None else wd_cache.WDCache(args.cache_dir)
+    server = serve(None if args.port is not None else args.socket, args.port, cache, args.root, args.output_dir)
+    print(f"Listening on {args.socket if args.port is None else f'127.0.0.1:{args.port}'}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if args.port is None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -1,11 +1,20 @@
+import itertools
+import os
+import tempfile
 import time
 
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 import algorithm
+import circuit_io
+import dot_io
 import graph_utils
+import verify
 import gen_circuits
+import gen_netlists
+import wd
+from retiming_graph import RetimingGraph, retiming_vector
 
 def test_graph(G: nx.DiGraph, expected_clock):
     W, D = algorithm.WD(G)
@@ -17,17 +26,218 @@ def test_graph(G: nx.DiGraph, expected_clock):
     time_2 = time.time()
     Gr_2 = algorithm.OPT_2(G, D)
     time_2 = time.time() - time_2
+    # Using OPT 3
+    time_3 = time.time()
+    Gr_3 = algorithm.OPT_3(G, W, D)
+    time_3 = time.time() - time_3
 
     # Check
     n_nodes_1, n_edges_1, f_clock_1 = graph_utils.graph_stats(Gr_1)
     # Check
     n_nodes_2, n_edges_2, f_clock_2 = graph_utils.graph_stats(Gr_2)
+    # Check
+    n_nodes_3, n_edges_3, f_clock_3 = graph_utils.graph_stats(Gr_3)
 
     assert f_clock_1 == f_clock_2, f"The clock of OPT_1 ({f_clock_1}) is not equal to the clock of OPT_2 ({f_clock_2})."
+    assert f_clock_1 == f_clock_3, f"The clock of OPT_1 ({f_clock_1}) is not equal to the clock of OPT_3 ({f_clock_3})."
     assert f_clock_1 == expected_clock, f"The clock ({f_clock_1}) is not equal to the expected one ({expected_clock})."
+    for Gr in [Gr_1, Gr_2, Gr_3]:
+        report = verify.verify(G, Gr, max_clock=expected_clock)
+        assert report['legal'], f"The retimed graph is not legal: {report['errors']}"
+
+    return n_nodes_1, n_edges_1, f_clock_1, time_1, time_2, time_3
+
+
+def test_wd_engines(G, tile_budget=2 ** 20):
+    # Every engine computes the W and D of the dense Floyd-Warshall: the sparse one with two
+    # processes, the blocked one on small tiles, the tiled one with a budget of a few tiles
+    W, D = algorithm.WD(G, method='dense')
+    results = {'sparse': wd.sparse(G, n_jobs=2), 'blocked': wd.blocked(G, block_size=32)}
+    with tempfile.TemporaryDirectory() as directory:
+        results['tiled'] = [np.array(M) for M in wd.tiled(G, directory=directory, tile_budget=tile_budget)]
+    for method, (W_m, D_m) in results.items():
+        assert np.array_equal(W_m, W), f"W of the {method} engine is not the one of the dense engine."
+        assert np.array_equal(D_m, D), f"D of the {method} engine is not the one of the dense engine."
+
+
+def test_feas_propagation(G: RetimingGraph, n_clocks=6):
+    # The worklist recomputes DELTA only below the flipped zero weight edges: at the candidate
+    # clocks around the minimum one FEAS must move the same vertices, for as many iterations,
+    # as when DELTA is recomputed in full
+    _, D = algorithm.WD(G)
+    candidates = algorithm.candidate_clocks(G, D)
+    i = int(np.searchsorted(candidates, algorithm.CP(algorithm.OPT_2(G, D)).max()))
+    for c in candidates[max(0, i - n_clocks):i + n_clocks].tolist():
+        stats_worklist, stats_full = {}, {}
+        r_worklist = algorithm._feas(G, c, 'worklist', stats_worklist)
+        r_full = algorithm._feas(G, c, 'full', stats_full)
+        assert stats_worklist == stats_full, f"Clock {c}: {stats_worklist} with the worklist, {stats_full} in full."
+        if r_full is None:
+            assert r_worklist is None, f"Clock {c} is feasible only with the worklist."
+        else:
+            assert np.array_equal(r_worklist, r_full), f"Clock {c}: the worklist gives another retiming."
+
+
+def test_min_area(G: RetimingGraph, c):
+    # Brute force: with r(0) = 0, a path from 0 to v and one back keep their registers only if
+    # -W(0, v) <= r(v) <= W(v, 0), so every legal retiming is in that box. The fewest registers
+    # of the retimings of clock at most c must be the ones of MIN_AREA.
+    W, D = algorithm.WD(G)
+    r = np.array(list(itertools.product(*(range(-W[0, v], W[v, 0] + 1) for v in range(G.n_nodes)))))
+    edge_w = G.edge_w + r[:, G.edge_dst] - r[:, G.edge_src]
+    legal = np.flatnonzero((edge_w >= 0).all(axis=1))
+    registers = edge_w.sum(axis=1)
+    best = None
+    for i in legal[np.argsort(registers[legal], kind='stable')]:
+        if algorithm.CP(G.retime(r[i])).max() <= c:
+            best = int(registers[i])
+            break
+
+    Gr = algorithm.MIN_AREA(G, W, D, c=c)
+    assert verify.verify(G, Gr, max_clock=c)['legal'], f"The MIN_AREA retiming of clock {c} is not legal."
+    assert graph_utils.count_registers(Gr) == best, \
+        f"MIN_AREA leaves {graph_utils.count_registers(Gr)} registers at clock {c}, the minimum is {best}."
+
+
+def test_circuit_file(G: RetimingGraph):
+    # A circuit file holds the graph, W, D and a retiming r as they were written, and a retiming
+    # only file applied to the graph read back gives the same retimed circuit
+    W, D = algorithm.WD(G)
+    Gr = algorithm.OPT_2(G, D)
+    r = retiming_vector(G, Gr)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "circuit" + circuit_io.EXTENSION)
+        circuit_io.write_circuit(filename, G=G, W=W, D=D, r=r)
+        circuit = circuit_io.read_circuit(filename)
+        Gf = circuit['G']
+        assert list(circuit['node_names']) == list(G.node_names), "The node names are not read back."
+        for name in ['delays', 'edge_src', 'edge_dst', 'edge_w', 'out_ptr', 'out_edges', 'in_ptr', 'in_edges']:
+            assert np.array_equal(getattr(Gf, name), getattr(G, name)), f"The {name} of the graph are not read back."
+        for name, a in [('W', W), ('D', D), ('r', r)]:
+            assert np.array_equal(circuit[name], a), f"{name} is not read back."
+        assert (algorithm.CP(Gf) == algorithm.CP(G)).all(), "The graph read back has another clock."
+
+        r_filename = os.path.join(directory, "r" + circuit_io.EXTENSION)
+        circuit_io.write_circuit(r_filename, r=r, node_names=circuit['node_names'])
+        r_only = circuit_io.read_circuit(r_filename)
+        assert 'G' not in r_only and list(r_only['node_names']) == list(G.node_names)
+        assert np.array_equal(G.retime(r_only['r']).edge_w, Gr.edge_w), "The retiming only file gives another circuit."
+
+
+def test_lean(G, block_rows):
+    # OPT_1_LEAN bisects the integer clocks with constraints found by bounded searches, without
+    # W and D: it must reach the clock of OPT_1, also when a search stopped at once is resumed
+    W, D = algorithm.WD(G)
+    clock = graph_utils.graph_stats(algorithm.OPT_1(G, W, D))[2]
+    Gr = algorithm.OPT_1_LEAN(G, block_rows=block_rows)
+    assert graph_utils.graph_stats(Gr)[2] == clock, f"OPT_1_LEAN gives {graph_utils.graph_stats(Gr)[2]}, OPT_1 {clock}."
+    assert verify.verify(G, Gr, max_clock=clock)['legal'], "The OPT_1_LEAN retiming is not legal."
+
+    state = algorithm.SearchState()
+    algorithm.OPT_1_LEAN(G, block_rows=block_rows, budget=0, state=state)
+    Gr = algorithm.OPT_1_LEAN(G, block_rows=block_rows, state=state)
+    assert state.done and graph_utils.graph_stats(Gr)[2] == clock, "The resumed OPT_1_LEAN does not reach the clock of OPT_1."
+
+
+def test_dot(G: RetimingGraph):
+    # A graph written by dot_io is read back with the same names, delays and edges
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "graph.dot")
+        dot_io.write_dot(G, filename)
+        Gd = dot_io.read_dot(filename)
+    assert list(Gd.node_names) == list(G.node_names), "The node names are not read back."
+    assert (Gd.delays == G.delays).all(), "The delays are not read back."
+    edges = sorted(zip(G.edge_src.tolist(), G.edge_dst.tolist(), G.edge_w.tolist()))
+    assert sorted(zip(Gd.edge_src.tolist(), Gd.edge_dst.tolist(), Gd.edge_w.tolist())) == edges, "The edges are not read back."
+
+
+def test_long_chain(n):
+    # A ring of n unit delays with a single register, moved to the middle: the check of the
+    # retiming visits the zero register path once, its time stays close to the one of CP
+    nodes = np.arange(n)
+    w = np.zeros(n, dtype=np.int64)
+    w[-1] = 1
+    G = RetimingGraph([f"v{i}" for i in range(n)], np.ones(n, dtype=np.int64), nodes, (nodes + 1) % n, w)
+    r = (nodes >= n // 2).astype(np.int64)
+    Gr = G.retime(r)
+
+    time_cp = time.time()
+    clock = int(algorithm.CP(Gr).max())
+    time_cp = time.time() - time_cp
+    time_verify = time.time()
+    report = verify.verify(G, Gr, max_clock=n)
+    time_verify = time.time() - time_verify
+
+    assert clock == n, f"The clock of the chain ({clock}) is not {n}."
+    assert report['legal'] and report['clock'] == n, f"The retimed chain is not legal: {report['errors']}"
+    assert (retiming_vector(G, Gr) == r - r[0]).all(), "The retiming vector of the chain is not found back."
+    assert time_verify < 20 * time_cp + 1, f"The check of the chain takes {time_verify} s, CP {time_cp} s."
+
+
+def test_parallel_search(G: RetimingGraph, n_jobs=3):
+    # The speculative search, where the probes out of the range stop early, reaches the clock
+    # of the binary search with OPT 1 and OPT 2
+    W, D = algorithm.WD(G)
+    clock = int(algorithm.CP(algorithm.OPT_1(G, W, D)).max())
+    for Gr in [algorithm.OPT_1(G, W, D, n_jobs=n_jobs), algorithm.OPT_2(G, D, n_jobs=n_jobs)]:
+        assert int(algorithm.CP(Gr).max()) == clock, f"The parallel search does not reach the clock {clock}."
+        assert verify.verify(G, Gr, max_clock=clock)['legal'], "The retiming of the parallel search is not legal."
+
+
+# Test the DOT files, the DOT keywords and the special characters are valid node names
+names = ['node', 'Edge', 'GRAPH', 'digraph', 'SubGraph', 'strict', 'a b', 'q"x', '-1', 'v0']
+test_dot(RetimingGraph(names, np.arange(10), np.arange(10), (np.arange(10) + 1) % 10, np.arange(10) % 3))
+test_dot(RetimingGraph.from_networkx(graph_utils.preprocess(gen_circuits.gen_correlator(8))))
+
+# Test the W and D engines on the circuits, and on an open pipeline where most pairs are unreachable
+for G in [gen_circuits.gen_correlator(30), gen_circuits.gen_tree(n_branch=3, depth=4), gen_circuits.gen_full_graph(120)]:
+    test_wd_engines(RetimingGraph.from_networkx(graph_utils.preprocess(G)))
+test_wd_engines(gen_netlists.random_netlist(300, seed=1))
+test_wd_engines(gen_netlists.random_k_out(200, seed=2))
+stages = np.arange(100)
+test_wd_engines(RetimingGraph([f"s{i}" for i in stages], stages % 7 + 1, np.r_[stages[:-1], stages[:-2]],
+                              np.r_[stages[1:], stages[2:]], np.r_[stages[:-1] % 3, stages[:-2] % 2]))
+
+# Test the DELTA worklist of FEAS against the full propagation, over the feasible and infeasible clocks
+for seed in range(3):
+    test_feas_propagation(gen_netlists.random_k_out(80, k_out=4, seed=seed))
+    test_feas_propagation(gen_netlists.random_netlist(200, register_prob=0.2, seed=seed))
+test_feas_propagation(RetimingGraph.from_networkx(graph_utils.preprocess(gen_circuits.gen_correlator(20))))
+
+# Test the speculative parallel search
+for seed in range(2):
+    test_parallel_search(gen_netlists.random_netlist(150, seed=seed))
+test_parallel_search(RetimingGraph.from_networkx(graph_utils.preprocess(gen_circuits.gen_correlator(12))))
+
+# Test MIN_AREA against every retiming of small circuits, at their minimum clock and at their own clock
+small = [gen_circuits.gen_correlator(3), gen_circuits.gen_correlator(4), gen_circuits.gen_tree(n_branch=1, depth=4),
+         gen_circuits.gen_tree(n_branch=2, depth=2)]
+small = [RetimingGraph.from_networkx(graph_utils.preprocess(G)) for G in small]
+small += [gen_netlists.random_k_out(6, k_out=2, max_delay=9, seed=seed) for seed in range(4)]
+small += [gen_netlists.random_netlist(7, register_prob=0.4, seed=seed) for seed in range(8)]
+for G in small:
+    W, D = algorithm.WD(G)
+    for c in sorted({int(algorithm.CP(algorithm.OPT_1(G, W, D)).max()), int(algorithm.CP(G).max())}):
+        test_min_area(G, c)
+
+# Test the circuit files, with names that are not plain identifiers
+test_circuit_file(RetimingGraph.from_networkx(graph_utils.preprocess(gen_circuits.gen_correlator(12))))
+test_circuit_file(gen_netlists.random_netlist(300, register_prob=0.2, seed=4))
+G = RetimingGraph.from_networkx(graph_utils.preprocess(gen_circuits.gen_tree(n_branch=2, depth=3)))
+test_circuit_file(RetimingGraph([f"état {v}" if v % 2 else f"n-{v}/q" for v in range(G.n_nodes)], G.delays,
+                                G.edge_src, G.edge_dst, G.edge_w))
 
-    return n_nodes_1, n_edges_1, f_clock_1, time_1, time_2
+# Test OPT_1_LEAN, with several blocks of sources, on the networkx circuits and on the array ones
+for i in [6, 13, 27]:
+    test_lean(graph_utils.preprocess(gen_circuits.gen_correlator(i)), block_rows=16)
+test_lean(graph_utils.preprocess(gen_circuits.gen_tree(n_branch=3, depth=3)), block_rows=7)
+test_lean(graph_utils.preprocess(gen_circuits.gen_full_graph(40)), block_rows=8)
+for seed in range(3):
+    test_lean(gen_netlists.random_netlist(250, seed=seed), block_rows=64)
+    test_lean(gen_netlists.random_k_out(60, k_out=5, seed=seed), block_rows=25)
 
+# Test the check of a retiming on a long zero register path
+test_long_chain(200000)
 
 file = open("test_result.csv", "w+")
 
@@ -36,16 +246,16 @@ for i in range(6, 50):
     G = gen_circuits.gen_correlator(i)
     G = graph_utils.preprocess(G)
     print(i)
-    nodes, edges, clock, t_1, t_2 = test_graph(G, 14)
-    file.write(f"Correlator {i} bit, {nodes}, {edges}, {clock}, {t_1}, {t_2}\n")
+    nodes, edges, clock, t_1, t_2, t_3 = test_graph(G, 14)
+    file.write(f"Correlator {i} bit, {nodes}, {edges}, {clock}, {t_1}, {t_2}, {t_3}\n")
     file.flush()
 
 # Test the graph
 for i in range(10, 500, 5):
     G = gen_circuits.gen_full_graph(i)
     G = graph_utils.preprocess(G)
-    nodes, edges, clock, t_1, t_2 = test_graph(G, 5)
-    file.write(f"Full graph {i} nodes, {nodes}, {edges}, {clock}, {t_1}, {t_2}\n")
+    nodes, edges, clock, t_1, t_2, t_3 = test_graph(G, 5)
+    file.write(f"Full graph {i} nodes, {nodes}, {edges}, {clock}, {t_1}, {t_2}, {t_3}\n")
     file.flush()
 
 # Test the tree
@@ -53,6 +263,6 @@ for i in range(1, 8):
     for j in range(1, 8):
         G = gen_circuits.gen_tree(n_branch=i, depth=j)
         G = graph_utils.preprocess(G)
-        nodes, edges, clock, t_1, t_2 = test_graph(G, 5)
-        file.write(f"Tree n_branch {i} depth {j}, {nodes}, {edges}, {clock}, {t_1}, {t_2}\n")
+        nodes, edges, clock, t_1, t_2, t_3 = test_graph(G, 5)
+        file.write(f"Tree n_branch {i} depth {j}, {nodes}, {edges}, {clock}, {t_1}, {t_2}, {t_3}\n")
         file.flush()
\ No newline at end of file
@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    # Collect timed events in the Chrome trace event format: the saved file can be opened in
+    # chrome://tracing or in Perfetto. The algorithms take tracer=None by default and then
+    # record nothing.
+
+    def __init__(self):
+        self.events = []
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def _now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def span(self, name, **args):
+        return _Span(self, name, args)
+
+    def complete(self, name, start, duration, args):
+        # Duration event, times in microseconds
+        self.events.append({'name': name, 'ph': 'X', 'ts': start, 'dur': duration,
+                            'pid': self.pid, 'tid': threading.get_ident(), 'args': args})
+
+    def counter(self, name, **values):
+        # Counter event: each value is a track that keeps its value until the next event
+        self.events.append({'name': name, 'ph': 'C', 'ts': self._now(), 'pid': self.pid, 'args': values})
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f, default=int)
+
+
+class _Span:
+    # The arguments dictionary is returned by __enter__, the sizes known only at the end of the
+    # span can be added to it
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer._now()
+        return self.args
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, self.tracer._now() - self.start, self.args)
+        return False
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(tracer, name, **args):
+    # Span of the tracer, or a span that does nothing if there is no tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(name, **args)
+
+
+def counter(tracer, name, **values):
+    # Counter event of the tracer, nothing if there is no tracer
+    if tracer is not None:
+        tracer.counter(name, **values)
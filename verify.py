@@ -0,0 +1,141 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+import circuit_io
+import graph_utils
+from retiming_graph import as_retiming_graph, copy_structure, retiming_vector, zero_register_delta
+
+# Check of a retimed circuit with a few passes over the node and edge arrays: the registers are
+# non negative, the retimed circuit is a retiming of the original one (a vector r exists, so
+# the registers of every cycle are unchanged), and its clock and registers are reported.
+
+
+def _aligned_edges(G, Gr):
+    # The retimed registers in the order of the edges of G, or None if Gr does not have the same
+    # nodes and edges. The graphs built by RetimingGraph.retime share their arrays with G.
+    if Gr.n_nodes != G.n_nodes or Gr.n_edges != G.n_edges:
+        return None
+    if Gr.edge_src is G.edge_src and Gr.edge_dst is G.edge_dst:
+        return Gr.edge_w
+
+    # Same node order, or the nodes of Gr renamed to the indices of G
+    if Gr.node_names is G.node_names or list(Gr.node_names) == list(G.node_names):
+        mapping = np.arange(G.n_nodes)
+    else:
+        index = G.node_index
+        try:
+            mapping = np.fromiter((index[name] for name in Gr.node_names), dtype=np.int64, count=Gr.n_nodes)
+        except KeyError:
+            return None
+    src, dst = mapping[Gr.edge_src], mapping[Gr.edge_dst]
+    if np.array_equal(src, G.edge_src) and np.array_equal(dst, G.edge_dst):
+        return Gr.edge_w
+
+    # The edges are in another order: match them by their endpoints
+    n = G.n_nodes
+    order, order_r = np.argsort(G.edge_src * n + G.edge_dst), np.argsort(src * n + dst)
+    if not (np.array_equal(G.edge_src[order], src[order_r]) and np.array_equal(G.edge_dst[order], dst[order_r])):
+        return None
+    edge_w = np.empty_like(Gr.edge_w)
+    edge_w[order] = Gr.edge_w[order_r]
+    return edge_w
+
+
+def _clock(G, edge_w):
+    # None if the edges without registers have a cycle
+    try:
+        delta = zero_register_delta(G, edge_w)
+    except ValueError:
+        return None
+    return int(delta.max()) if delta.size else 0
+
+
+def verify(G, Gr, r=None, max_clock=None):
+    # Report of the check of the retimed circuit Gr against the original one G. If the retiming
+    # vector r is given, the registers of Gr must be the ones of G retimed by r. If max_clock is
+    # given, the clock of Gr must not exceed it.
+    G, _ = as_retiming_graph(G)
+    Gr, _ = as_retiming_graph(Gr)
+    report = {'nodes': G.n_nodes, 'edges': G.n_edges, 'errors': []}
+    errors = report['errors']
+
+    edge_w = _aligned_edges(G, Gr)
+    if edge_w is None:
+        errors.append("the retimed graph does not have the nodes and the edges of the original one")
+        report['legal'] = False
+        return report
+
+    negative = np.flatnonzero(edge_w < 0)
+    if negative.size:
+        errors.append(f"{negative.size} edges with a negative number of registers, e.g. "
+                      f"{G.node_names[G.edge_src[negative[0]]]} -> {G.node_names[G.edge_dst[negative[0]]]}")
+
+    # w_r(e) = w(e) + r(v) - r(u) for every edge: the registers of every cycle are unchanged
+    if r is None:
+        Gr_aligned = copy_structure(G)
+        Gr_aligned.edge_w = edge_w
+        consistent = retiming_vector(G, Gr_aligned) is not None
+    else:
+        r = np.asarray(r, dtype=np.int64)
+        consistent = r.size == G.n_nodes and np.array_equal(edge_w, G.edge_w + r[G.edge_dst] - r[G.edge_src])
+    if not consistent:
+        errors.append("the retimed graph is not a retiming of the original one")
+
+    report['registers'] = int(edge_w.sum())
+    report['original registers'] = int(G.edge_w.sum())
+    report['clock'] = _clock(G, edge_w)
+    report['original clock'] = _clock(G, G.edge_w)
+    if report['clock'] is None:
+        errors.append("the retimed graph has a cycle without registers")
+    elif max_clock is not None and report['clock'] > max_clock:
+        errors.append(f"the clock {report['clock']} is greater than {max_clock}")
+
+    report['legal'] = not errors
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check a retimed circuit')
+
+    parser.add_argument('--original',
+                        action='store',
+                        type=str,
+                        help='original circuit (dot or binary circuit file)',
+                        default='example.dot')
+
+    parser.add_argument('--retimed',
+                        action='store',
+                        type=str,
+                        help='retimed circuit, or binary circuit file holding only the retiming vector r',
+                        default='output.dot')
+
+    parser.add_argument('--clock',
+                        action='store',
+                        type=int,
+                        help='if set, the clock of the retimed circuit must not exceed it',
+                        default=None)
+
+    args = parser.parse_args()
+
+    start = time.time()
+    G = graph_utils.load_graph(args.original)
+    r = None
+    if args.retimed.endswith(circuit_io.EXTENSION):
+        circuit = circuit_io.read_circuit(args.retimed)
+        r = circuit.get('r')
+        # A retiming only file (opt_1.py --retiming-only True) is applied to the original circuit
+        Gr = circuit['G'] if 'G' in circuit else G.retime(r)
+    else:
+        Gr = graph_utils.load_graph(args.retimed)
+    load_time = time.time() - start
+
+    start = time.time()
+    report = verify(G, Gr, r, args.clock)
+    report['load time'] = load_time
+    report['verify time'] = time.time() - start
+    print(json.dumps(report, indent=1))
+    sys.exit(0 if report['legal'] else 1)
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from retiming_graph import as_retiming_graph
+
+DEFAULT_CACHE_DIR = '.wd_cache'
+# Total size of the cached files, the least recently used ones are evicted above it
+DEFAULT_CACHE_SIZE = 1024 * 2 ** 20
+
+# Bumped whenever the content of the cached files changes
+CACHE_VERSION = b'wd-1'
+
+
+def graph_key(G):
+    # Hash of the circuit: node names (in order, they index the rows of W and D), delays and
+    # the edges sorted by endpoints, so that the order of the edges does not matter
+    RG, _ = as_retiming_graph(G)
+    order = np.lexsort((RG.edge_dst, RG.edge_src))
+    h = hashlib.sha256(CACHE_VERSION)
+    h.update('\0'.join(str(name) for name in RG.node_names).encode())
+    for a in (RG.delays, RG.edge_src[order], RG.edge_dst[order], RG.edge_w[order]):
+        h.update(b'\0')
+        h.update(np.ascontiguousarray(a, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+class WDCache:
+    # W, D and the candidate clocks of the circuits, one compressed .npz file per circuit.
+    # The last entry is also kept in memory, so repeated runs on a circuit do not even read it.
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._last = (None, None)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load(self, G):
+        # (W, D, candidates) of G, or None if G is not in the cache
+        key = graph_key(G)
+        if self._last[0] == key:
+            return self._last[1]
+
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                entry = data['W'], data['D'], data['candidates']
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # The modification time is the last use of the entry
+        os.utime(path)
+        self._last = (key, entry)
+        return entry
+
+    def store(self, G, W, D, candidates):
+        key = graph_key(G)
+        entry = np.asarray(W), np.asarray(D), np.asarray(candidates)
+
+        # Write to a temporary file first: concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, W=entry[0], D=entry[1], candidates=entry[2])
+        os.replace(tmp_path, self.path(key))
+
+        self._last = (key, entry)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        # Remove the least recently used entries until the cache fits in max_bytes
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.npz') and name != f"{keep}.npz":
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.exists(self.path(keep)):
+            total += os.path.getsize(self.path(keep))
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size